@@ -1,9 +1,18 @@
 import vtk
 import os
 import sys
+import csv
+import json
+import asyncio
+import argparse
+import time
+import hashlib
 import numpy as np
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QFrame, QGridLayout, QSizePolicy, QSlider,  QPushButton, QFileDialog, QInputDialog, QVBoxLayout, QGroupBox
+from concurrent.futures import ThreadPoolExecutor
+from vtkmodules.util import numpy_support
+from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QFrame, QGridLayout, QSizePolicy, QSlider,  QPushButton, QFileDialog, QInputDialog, QVBoxLayout, QHBoxLayout, QGroupBox, QShortcut, QComboBox
 from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QKeySequence
 from vtkmodules.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 
 def choose_files():
@@ -13,11 +22,11 @@ def choose_files():
         print("No image file selected. Exiting.")
         sys.exit(1)  # Exit if no file is chosen
 
-    # selecting a mask file
-    mask_file, _ = QFileDialog.getOpenFileName(None, "Choose Mask File", "", "NIfTI Files (*.nii.gz);")
+    # selecting a mask file (optional: without one the bones are segmented from the CT)
+    mask_file, _ = QFileDialog.getOpenFileName(None, "Choose Mask File (Cancel to generate one)", "", "NIfTI Files (*.nii.gz);")
     if not mask_file:
-        print("No mask file selected. Exiting.")
-        sys.exit(1)  # Exit if no file is chosen
+        print("No mask file selected. A bone mask will be generated from the CT.")
+        mask_file = None
 
     # selecting a prosthesis file
     prosthesis_file, _ = QFileDialog.getOpenFileName(None, "Choose Prosthesis File", "", "STL Files (*.stl)")
@@ -35,12 +44,625 @@ def choose_files():
 
 
 
+# BUILT-IN BONE SEGMENTATION
+# used when no mask file is given: HU thresholding + 3D connected components in the bounding box of the
+# thresholded voxels + hole filling
+
+BONE_HU_MIN = 200  # below this it is soft tissue / fat / air
+BONE_HU_MAX = 3000  # above this it is metal (implants, table screws)
+BONE_KEEP_COMPONENTS = 3  # pelvis + both femurs
+BONE_MIN_COMPONENT_VOXELS = 1000  # smaller islands are noise or calcifications
+MASK_CACHE_DIR = ".bone_mask_cache"
+USER_MASK_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "hip_replacement", "bone_masks")  # case folder read-only
+
+
+def image_to_array(image_data): # view the vtkImageData scalars as a (z, y, x) numpy array (no copy)
+    nx, ny, nz = image_data.GetDimensions()
+    return numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars()).reshape(nz, ny, nx)
+
+
+def array_to_image(array, spacing, origin): # wrap a (z, y, x) numpy array into a vtkImageData
+    image = vtk.vtkImageData()
+    image.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    scalars = numpy_support.numpy_to_vtk(np.ascontiguousarray(array).ravel(), deep=True)
+    image.GetPointData().SetScalars(scalars)
+    return image
+
+
+def bone_mask_cache_paths(image_path, hu_min, hu_max, keep_components, min_voxels):
+    # the cache key depends on the CT file itself and on the segmentation parameters
+    stat = os.stat(image_path)
+    key = f"{os.path.realpath(image_path)}|{stat.st_size}|{stat.st_mtime}|{hu_min}|{hu_max}|{keep_components}|{min_voxels}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+    name = os.path.basename(image_path).split(".")[0]
+    file_name = f"{name}_bones_{digest}.nii.gz"
+    # next to the CT, or in the user cache when the case folder cannot be written (read-only / network share)
+    return [
+        os.path.join(os.path.dirname(os.path.abspath(image_path)), MASK_CACHE_DIR, file_name),
+        os.path.join(USER_MASK_CACHE_DIR, file_name),
+    ]
+
+
+def writable_directory(directory): # True if the directory exists (or can be created) and can be written to
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(directory, os.W_OK)
+
+
+def threshold_in_chunks(ct, raw_min, raw_max, chunk_slices=16):
+    # threshold the CT slab by slab on a thread pool (numpy releases the GIL on large arrays)
+    # each slab also reports its occupancy so the bounding box comes for free
+    binary = np.empty(ct.shape, dtype=np.uint8)
+
+    def threshold_slab(start):
+        stop = min(start + chunk_slices, ct.shape[0])
+        slab = binary[start:stop].view(bool)
+        np.greater_equal(ct[start:stop], raw_min, out=slab)
+        slab &= ct[start:stop] <= raw_max
+        return start, slab.any(axis=(1, 2)), slab.any(axis=0)
+
+    z_occupied = np.zeros(ct.shape[0], dtype=bool)
+    yx_occupied = np.zeros(ct.shape[1:], dtype=bool)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        for start, slab_z, slab_yx in pool.map(threshold_slab, range(0, ct.shape[0], chunk_slices)):
+            z_occupied[start:start + len(slab_z)] = slab_z
+            yx_occupied |= slab_yx
+    return binary, z_occupied, yx_occupied
+
+
+def largest_components(binary_image, keep_components, min_voxels):
+    # 3D connected components, labels ranked by size (1 = largest)
+    connectivity = vtk.vtkImageConnectivityFilter()
+    connectivity.SetInputData(binary_image)
+    connectivity.SetScalarRange(1, 1)
+    connectivity.SetExtractionModeToAllRegions()
+    connectivity.SetLabelModeToSizeRank()
+    connectivity.SetLabelScalarTypeToInt()
+    connectivity.SetSizeRange(min_voxels, binary_image.GetNumberOfPoints())
+    connectivity.Update()
+    labels = image_to_array(connectivity.GetOutput())
+    return (labels > 0) & (labels <= keep_components)
+
+
+def fill_holes(bone, spacing, origin):
+    # marrow cavities: background not connected to the border of its axial slice. filled in 2D because the femoral
+    # shafts and the pelvis are usually cut by the field of view, so their canals are open to the outside in 3D.
+    # all the slices are labelled in one pass, separated by walls (not background) so that they do not connect in z
+    nz, ny, nx = bone.shape
+    background = np.zeros((2 * nz - 1, ny + 2, nx + 2), dtype=np.uint8)
+    background[::2] = np.pad(~bone, ((0, 0), (1, 1), (1, 1)), constant_values=True)
+    connectivity = vtk.vtkImageConnectivityFilter()
+    connectivity.SetInputData(array_to_image(background, spacing, origin))
+    connectivity.SetScalarRange(1, 1)
+    connectivity.SetExtractionModeToAllRegions()
+    connectivity.SetLabelScalarTypeToInt()
+    connectivity.Update()
+    labels = image_to_array(connectivity.GetOutput())[::2]
+    outside = np.isin(labels, labels[:, 0, 0])  # the padded border of a slice is one region
+    return ~outside[:, 1:-1, 1:-1]
+
+
+def generate_bone_mask(nifti_reader, image_path, hu_min=BONE_HU_MIN, hu_max=BONE_HU_MAX,
+                       keep_components=BONE_KEEP_COMPONENTS, min_voxels=BONE_MIN_COMPONENT_VOXELS):
+    # returns the path of a 0/1 NIfTI bone mask on the CT grid, computed once and then read from the cache
+    cache_paths = bone_mask_cache_paths(image_path, hu_min, hu_max, keep_components, min_voxels)
+    for cache_path in cache_paths:
+        if os.path.exists(cache_path):
+            print(f"Using cached bone mask: {cache_path}")
+            return cache_path
+
+    image_data = nifti_reader.GetOutput()
+    spacing = image_data.GetSpacing()
+    origin = image_data.GetOrigin()
+    ct = image_to_array(image_data)
+
+    # HU thresholds converted to raw stored values (NIfTI scl_slope / scl_inter)
+    slope = nifti_reader.GetRescaleSlope() or 1.0
+    intercept = nifti_reader.GetRescaleIntercept()
+    raw_min, raw_max = sorted(((hu_min - intercept) / slope, (hu_max - intercept) / slope))
+
+    binary, z_occupied, yx_occupied = threshold_in_chunks(ct, raw_min, raw_max)
+    mask = np.zeros(ct.shape, dtype=np.uint8)
+
+    if z_occupied.any():
+        # ROI: bounding box of the thresholded voxels, connectivity and hole filling only run inside it
+        z0, z1 = np.flatnonzero(z_occupied)[[0, -1]]
+        y0, y1 = np.flatnonzero(yx_occupied.any(axis=1))[[0, -1]]
+        x0, x1 = np.flatnonzero(yx_occupied.any(axis=0))[[0, -1]]
+        roi = np.s_[z0:z1 + 1, y0:y1 + 1, x0:x1 + 1]
+        roi_origin = [origin[0] + x0 * spacing[0], origin[1] + y0 * spacing[1], origin[2] + z0 * spacing[2]]
+
+        bone = largest_components(array_to_image(binary[roi], spacing, roi_origin), keep_components, min_voxels)
+        mask[roi] = fill_holes(bone, spacing, roi_origin)
+    else:
+        print(f"No voxels between {hu_min} and {hu_max} HU: the bone mask is empty.")
+
+    # write the mask on the same grid (and with the same orientation) as the CT
+    cache_path = next((path for path in cache_paths if writable_directory(os.path.dirname(path))), cache_paths[-1])
+    write_nifti(array_to_image(mask, spacing, origin), cache_path, nifti_reader)
+    print(f"Bone mask generated: {cache_path}")
+    return cache_path
+
+
+def write_nifti(image_data, path, nifti_reader, rescale=False): # write an image on the CT grid, with the orientation of the CT file
+    # rescale: the values are raw CT values, the CT's scl_slope / scl_inter are written too so they read back in HU
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    writer = vtk.vtkNIFTIImageWriter()
+    writer.SetInputData(image_data)
+    if rescale:
+        writer.SetRescaleSlope(nifti_reader.GetRescaleSlope() or 1.0)
+        writer.SetRescaleIntercept(nifti_reader.GetRescaleIntercept())
+    if nifti_reader.GetQFormMatrix() is not None:
+        writer.SetQFormMatrix(nifti_reader.GetQFormMatrix())
+    if nifti_reader.GetSFormMatrix() is not None:
+        writer.SetSFormMatrix(nifti_reader.GetSFormMatrix())
+    writer.SetFileName(path)
+    writer.Write()
+
+
+
+# RENDER WIDGETS: on screen (Qt) or offscreen (render server)
+
+class OffscreenRenderWidget(QWidget):
+    # stands in for QVTKRenderWindowInteractor when nothing is shown: same GetRenderWindow() API, the
+    # interactor is only there for the widgets / interactor styles the pipeline attaches to it
+    def __init__(self, parent=None, size=(512, 512)):
+        super().__init__(parent)
+        self.render_window = vtk.vtkRenderWindow()
+        self.render_window.SetOffScreenRendering(1)
+        self.render_window.SetSize(*size)
+        self.interactor = vtk.vtkGenericRenderWindowInteractor()
+        self.interactor.SetRenderWindow(self.render_window)
+
+    def GetRenderWindow(self):
+        return self.render_window
+
+
+def create_render_widget(parent, offscreen=False):
+    return OffscreenRenderWidget(parent) if offscreen else QVTKRenderWindowInteractor(parent)
+
+
+
+# MEASUREMENT GEOMETRY (all points in world coordinates, mm)
+
+def world_distance(point1, point2):
+    return float(np.linalg.norm(np.asarray(point2, dtype=float) - np.asarray(point1, dtype=float)))
+
+
+def world_angle(point1, vertex, point2): # angle at the vertex, in degrees
+    v1 = np.asarray(point1, dtype=float) - np.asarray(vertex, dtype=float)
+    v2 = np.asarray(point2, dtype=float) - np.asarray(vertex, dtype=float)
+    norms = np.linalg.norm(v1) * np.linalg.norm(v2)
+    if norms == 0:
+        return 0.0
+    return float(np.degrees(np.arccos(np.clip(np.dot(v1, v2) / norms, -1.0, 1.0))))
+
+
+
+def throttled(callback, interval_ms=30): # observer that runs callback at most once per interval (bursts are merged)
+    timer = QTimer()
+    timer.setSingleShot(True)
+    timer.setInterval(interval_ms)
+    timer.timeout.connect(callback)
+
+    def observer(obj=None, event=None):
+        if not timer.isActive():
+            timer.start()
+
+    observer.timer = timer  # keep the timer alive as long as the observer
+    return observer
+
+
+
+# ANNOTATIONS: every measurement (2D views and 3D view) with its world coordinates, saved per case
+
+ANNOTATION_DIR = ".annotations"
+ANNOTATION_KINDS = ["distance", "angle"]
+ANNOTATION_VIEWS = ["axial", "coronal", "sagittal", "3d"]
+
+
+def case_path(image_path, directory, extension): # per-case files are saved in a sub-directory next to the CT
+    name = os.path.basename(image_path).split(".")[0]
+    return os.path.join(os.path.dirname(os.path.abspath(image_path)), directory, f"{name}{extension}")
+
+
+def annotation_path(image_path):
+    return case_path(image_path, ANNOTATION_DIR, ".npz")
+
+
+class AnnotationStore:
+    # one row per measurement in flat arrays (grown by doubling), up to 3 world points per row (unused ones are NaN)
+    # hit testing goes through a vtkStaticPointLocator over all the points, rebuilt only after a change
+    def __init__(self, capacity=16):
+        self.count = 0
+        self.kinds = np.zeros(capacity, dtype=np.uint8)
+        self.views = np.zeros(capacity, dtype=np.uint8)
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.points = np.full((capacity, 3, 3), np.nan, dtype=np.float32)
+        self.locator = None
+        self.revision = 0  # bumped on every change, so the views know when to redraw
+
+    def __len__(self):
+        return self.count
+
+    def grow(self):
+        capacity = 2 * len(self.kinds)
+        for name, fill in (("kinds", 0), ("views", 0), ("values", 0), ("points", np.nan)):
+            old = getattr(self, name)
+            new = np.full((capacity,) + old.shape[1:], fill, dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def add(self, kind, view, value, points): # returns the index of the new annotation
+        if self.count == len(self.kinds):
+            self.grow()
+        self.count += 1
+        self.update(self.count - 1, kind, view, value, points)
+        return self.count - 1
+
+    def update(self, index, kind, view, value, points):
+        self.kinds[index] = ANNOTATION_KINDS.index(kind)
+        self.views[index] = ANNOTATION_VIEWS.index(view)
+        self.values[index] = value
+        self.points[index] = np.nan
+        self.points[index, :len(points)] = points
+        self.locator = None  # rebuilt on the next hit test
+        self.revision += 1
+
+    def get(self, index):
+        points = self.points[index]
+        return {
+            "kind": ANNOTATION_KINDS[self.kinds[index]],
+            "view": ANNOTATION_VIEWS[self.views[index]],
+            "value": float(self.values[index]),
+            "points": points[~np.isnan(points[:, 0])].astype(float),
+        }
+
+    def describe(self, index):
+        annotation = self.get(index)
+        unit = "mm" if annotation["kind"] == "distance" else "°"
+        return f"#{index + 1} {annotation['kind']} ({annotation['view']}): {annotation['value']:.2f} {unit}"
+
+    def hit_test(self, point, radius): # annotations with a point closer than radius (mm), nearest first
+        if self.count == 0:
+            return []
+        if self.locator is None:
+            flat = self.points[:self.count].reshape(-1, 3)
+            valid = np.flatnonzero(~np.isnan(flat[:, 0]))
+            self.locator_coordinates = flat[valid].astype(np.float64)
+            self.locator_owners = valid // 3
+            vtk_points = vtk.vtkPoints()
+            vtk_points.SetData(numpy_support.numpy_to_vtk(self.locator_coordinates, deep=True))
+            self.locator_points = vtk.vtkPolyData()
+            self.locator_points.SetPoints(vtk_points)
+            self.locator = vtk.vtkStaticPointLocator()
+            self.locator.SetDataSet(self.locator_points)
+            self.locator.BuildLocator()
+
+        ids = vtk.vtkIdList()
+        self.locator.FindPointsWithinRadius(radius, tuple(point), ids)
+        found = np.array([ids.GetId(i) for i in range(ids.GetNumberOfIds())], dtype=int)
+        if len(found) == 0:
+            return []
+        distances = np.linalg.norm(self.locator_coordinates[found] - np.asarray(point, dtype=float), axis=1)
+        owners = self.locator_owners[found[np.argsort(distances)]]
+        _, first = np.unique(owners, return_index=True)
+        return [int(index) for index in owners[np.sort(first)]]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez_compressed(
+            path,
+            kinds=self.kinds[:self.count], views=self.views[:self.count],
+            values=self.values[:self.count], points=self.points[:self.count],
+        )
+
+    @classmethod
+    def load(cls, path): # empty store if the case has no annotations yet
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as data:
+            store = cls(capacity=max(16, len(data["kinds"])))
+            store.count = len(data["kinds"])
+            for name in ("kinds", "views", "values", "points"):
+                getattr(store, name)[:store.count] = data[name]
+        return store
+
+
+def export_annotations(image_paths, csv_path): # bulk export of the annotations of many cases into one CSV file
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        stores = list(pool.map(lambda path: AnnotationStore.load(annotation_path(path)), image_paths))
+
+    with open(csv_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["case", "index", "kind", "view", "value"] + [f"p{i}_{axis}" for i in (1, 2, 3) for axis in "xyz"])
+        for image_path, store in zip(image_paths, stores):
+            case = os.path.basename(image_path).split(".")[0]
+            for index in range(len(store)):
+                annotation = store.get(index)
+                writer.writerow(
+                    [case, index + 1, annotation["kind"], annotation["view"], f"{annotation['value']:.3f}"]
+                    + [f"{value:.3f}" for value in store.points[index].ravel()]
+                )
+    print(f"Exported the annotations of {len(image_paths)} cases to {csv_path}")
+
+
+def export_annotations_main(argv): # python Group12.py --export-annotations out.csv case1.nii.gz case2.nii.gz ...
+    parser = argparse.ArgumentParser(prog="Group12.py --export-annotations", description="Export the measurements of many cases to one CSV file.")
+    parser.add_argument("csv", help="output CSV file")
+    parser.add_argument("images", nargs="+", help="CT images of the cases")
+    args = parser.parse_args(argv)
+    export_annotations(args.images, args.csv)
+
+
+
+# IMPLANT POSE: translation + rotation quaternion (w, x, y, z) + uniform scale, actor matrix = T * R * S
+
+def quaternion_multiply(q1, q2):
+    w1, x1, y1, z1 = q1
+    w2, x2, y2, z2 = q2
+    return np.array([
+        w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+        w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+        w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+    ])
+
+
+def quaternion_from_axis_angle(axis, angle_degrees):
+    axis = np.asarray(axis, dtype=float)
+    half = np.radians(angle_degrees) / 2
+    return np.concatenate(([np.cos(half)], np.sin(half) * axis / np.linalg.norm(axis)))
+
+
+def quaternion_to_matrix(q):
+    w, x, y, z = q
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+    ])
+
+
+class ImplantPose:
+    def __init__(self, translation=(0, 0, 0), rotation=(1, 0, 0, 0), scale=1.0):
+        self.translation = np.array(translation, dtype=float)
+        self.rotation = np.array(rotation, dtype=float) / np.linalg.norm(rotation)
+        self.scale = float(scale)
+
+    @classmethod
+    def from_transform(cls, transform, scale=1.0): # pose of a rigid vtkTransform (translations + rotations only)
+        angle, *axis = transform.GetOrientationWXYZ()
+        rotation = quaternion_from_axis_angle(axis, angle) if angle else (1, 0, 0, 0)
+        return cls(transform.GetPosition(), rotation, scale)
+
+    @classmethod
+    def from_array(cls, values): # inverse of as_array
+        return cls(values[:3], values[3:7], values[7])
+
+    def as_array(self): # 8 numbers: tx, ty, tz, qw, qx, qy, qz, scale
+        return np.concatenate((self.translation, self.rotation, [self.scale]))
+
+    # pose changes return a new pose; steps are expressed in the implant axes, like the former vtkTransform calls
+    def translated(self, delta):
+        return ImplantPose(self.translation + quaternion_to_matrix(self.rotation) @ np.asarray(delta, dtype=float), self.rotation, self.scale)
+
+    def rotated(self, axis, angle_degrees):
+        return ImplantPose(self.translation, quaternion_multiply(self.rotation, quaternion_from_axis_angle(axis, angle_degrees)), self.scale)
+
+    def scaled(self, factor):
+        return ImplantPose(self.translation, self.rotation, self.scale * factor)
+
+    def matrix(self): # 4x4 actor matrix, built directly from the pose (no chain of transforms)
+        elements = np.eye(4)
+        elements[:3, :3] = quaternion_to_matrix(self.rotation) * self.scale
+        elements[:3, 3] = self.translation
+        matrix = vtk.vtkMatrix4x4()
+        matrix.DeepCopy(elements.ravel())
+        return matrix
+
+
+def side_transform(side): # initial placement of the implant on the right / left hip joint (rigid transform)
+    transform = vtk.vtkTransform()
+
+    if side == "Right":
+        # Translation adjustment
+        transform.Translate(58, 145, 68)  # Fine-tuned translation closer to the joint
+
+        # Rotation adjustments
+        transform.RotateWXYZ(90, 0, 1, 0)   # Flip around the Y-axis (kept as-is)
+        transform.RotateWXYZ(85, 1, 0, 0)   # Refined rotation along X-axis for ball position
+        transform.RotateWXYZ(-45, 0, 0, 1)  # Adjust Z-axis rotation for shaft alignment
+        transform.RotateWXYZ(20, -1, -0.2, 0)  # Minor tilt correction
+        transform.RotateWXYZ(15, 0, 0, 1)   # Small Z-axis fine-tuning
+
+    elif side == "Left":
+        transform.Translate(280, 165, 30)
+        transform.RotateWXYZ(-90, 1, 0, 0)
+        transform.RotateWXYZ(45, 0, 1, 1)
+        transform.RotateWXYZ(-30, 0, 1, 0)
+
+    return transform
+
+
+class PoseHistory:
+    # undo / redo of implant poses, one row of 8 numbers per pose in a single array
+    def __init__(self, pose, max_size=500):
+        self.max_size = max_size
+        self.rows = np.zeros((16, 8))
+        self.rows[0] = pose.as_array()
+        self.size = 1  # rows in use (the ones after current can be redone)
+        self.current = 0
+
+    def push(self, pose):
+        self.size = self.current + 1  # a new change drops the redo branch
+        if self.size == self.max_size:  # forget the oldest pose
+            self.rows[:self.size - 1] = self.rows[1:self.size]
+            self.size -= 1
+        if self.size == len(self.rows):
+            self.rows = np.concatenate((self.rows, np.zeros_like(self.rows)))
+        self.rows[self.size] = pose.as_array()
+        self.current = self.size
+        self.size += 1
+
+    def undo(self): # previous pose, or None at the start of the history
+        if self.current == 0:
+            return None
+        self.current -= 1
+        return ImplantPose.from_array(self.rows[self.current])
+
+    def redo(self): # next pose, or None if nothing was undone
+        if self.current == self.size - 1:
+            return None
+        self.current += 1
+        return ImplantPose.from_array(self.rows[self.current])
+
+
+
+# PLAN EXPORT: the posed implant scan-converted on the CT grid, for comparison with the post-op CT
+
+EXPORT_DIR = ".exports"
+IMPLANT_HU = 3071  # value of the implant voxels in the fused CT (top of the usual CT range, like metal)
+
+
+def implant_stencil(polydata, matrix, image_data):
+    # scan conversion of the closed implant surface (posed by matrix) into a stencil covering the CT grid
+    transform = vtk.vtkTransform()
+    transform.SetMatrix(matrix)
+    posed = vtk.vtkTransformPolyDataFilter()
+    posed.SetInputData(polydata)
+    posed.SetTransform(transform)
+
+    stencil = vtk.vtkPolyDataToImageStencil()
+    stencil.SetInputConnection(posed.GetOutputPort())
+    stencil.SetOutputOrigin(image_data.GetOrigin())
+    stencil.SetOutputSpacing(image_data.GetSpacing())
+    stencil.SetOutputWholeExtent(image_data.GetExtent())
+    stencil.Update()
+    return stencil
+
+
+def export_plan(polydata, matrix, nifti_reader, image_path): # writes the implant mask and the fused CT + implant
+    image_data = nifti_reader.GetOutput()
+    stencil = implant_stencil(polydata, matrix, image_data)
+
+    # planned implant mask (1 inside, 0 outside)
+    implant_mask = vtk.vtkImageStencilToImage()
+    implant_mask.SetInputConnection(stencil.GetOutputPort())
+    implant_mask.SetInsideValue(1)
+    implant_mask.SetOutsideValue(0)
+    implant_mask.SetOutputScalarTypeToUnsignedChar()
+    implant_mask.Update()
+
+    # fused volume: the CT with the implant voxels replaced by metal (value stored in the CT's raw units)
+    slope = nifti_reader.GetRescaleSlope() or 1.0
+    metal = (IMPLANT_HU - nifti_reader.GetRescaleIntercept()) / slope
+    fused = vtk.vtkImageStencil()
+    fused.SetInputData(image_data)
+    fused.SetStencilConnection(stencil.GetOutputPort())
+    fused.ReverseStencilOn()
+    fused.SetBackgroundValue(min(max(metal, image_data.GetScalarTypeMin()), image_data.GetScalarTypeMax()))
+    fused.Update()
+
+    mask_path = case_path(image_path, EXPORT_DIR, "_planned_implant.nii.gz")
+    fused_path = case_path(image_path, EXPORT_DIR, "_fused_plan.nii.gz")
+    write_nifti(implant_mask.GetOutput(), mask_path, nifti_reader)
+    write_nifti(fused.GetOutput(), fused_path, nifti_reader, rescale=True)
+    return mask_path, fused_path
+
+
+
+# SESSIONS: implant pose, cut, camera and slice positions of a case, restored when the case is opened again
+
+SESSION_DIR = ".sessions"
+
+
+def session_path(image_path):
+    return case_path(image_path, SESSION_DIR, ".json")
+
+
+
+# MEMORY BUDGET: estimated footprint of each pipeline stage at load time, downsampled 3D volume / previews above it
+
+MEMORY_BUDGET_MB = 8192  # default for a 16 GB laptop, change with --memory-budget MB
+VOLUME_RENDERING_OVERHEAD = 2  # GPU ray casting: texture + host staging copy of the mask scalars
+MAX_DOWNSAMPLING = 8
+
+
+def resident_memory_mb(): # resident memory of the process (None where it cannot be read)
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # peak only: kB on Linux, bytes on macOS
+        return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+    except ImportError:
+        return None
+
+
+class MemoryMonitor:
+    # estimates come before a stage is built, measurements (resident memory growth) right after it
+    def __init__(self, budget_mb):
+        self.budget_mb = budget_mb
+        self.estimates = {}  # stage -> MB
+        self.measured = {}  # stage -> MB
+        self.last_resident = resident_memory_mb()
+
+    def estimate(self, stage, megabytes):
+        self.estimates[stage] = megabytes
+
+    def measure(self, stage): # resident memory added since the previous measurement
+        resident = resident_memory_mb()
+        if resident is not None and self.last_resident is not None:
+            self.measured[stage] = resident - self.last_resident
+        self.last_resident = resident
+
+    def downsampling_factor(self, stage): # smallest factor (per axis) bringing the total under the budget
+        others = sum(megabytes for name, megabytes in self.estimates.items() if name != stage)
+        for factor in range(1, MAX_DOWNSAMPLING + 1):
+            if others + self.estimates[stage] / factor**3 <= self.budget_mb:
+                return factor
+        print(f"Warning: the scan does not fit in the {self.budget_mb} MB memory budget even downsampled {MAX_DOWNSAMPLING}x.")
+        return MAX_DOWNSAMPLING
+
+    def report(self):
+        print(f"Memory per stage (budget {self.budget_mb} MB, resident now {resident_memory_mb() or 0:.0f} MB):")
+        for stage in dict.fromkeys(list(self.estimates) + list(self.measured)):
+            estimated = f"{self.estimates[stage]:8.1f}" if stage in self.estimates else "       -"
+            measured = f"{self.measured[stage]:8.1f}" if stage in self.measured else "       -"
+            print(f"  {stage:<20} estimated {estimated} MB   resident {measured} MB")
+
+
+
+def downsample_volume(image_data, factor): # max of each block of factor^3 voxels, placed at the centre of the block
+    shrink = vtk.vtkImageShrink3D()
+    shrink.SetInputData(image_data)
+    shrink.SetShrinkFactors(factor, factor, factor)
+    shrink.MaximumOn()
+
+    # the shrink keeps the input origin (each block lands on its first voxel): move the output to the block centres
+    centred = vtk.vtkImageChangeInformation()
+    centred.SetInputConnection(shrink.GetOutputPort())
+    centred.SetOriginTranslation(*[(factor - 1) / 2 * spacing for spacing in image_data.GetSpacing()])
+    centred.Update()
+    return centred
+
+
+
 # all this class is to visualize the multi planar view of the CT scan
 class MPRVisualizer:
-    def __init__(self, image_data, orientation, parent_widget):
+    def __init__(self, image_data, orientation, parent_widget, annotations=None, offscreen=False):
         self.image_data = image_data
         self.orientation = orientation
         self.parent_widget = parent_widget
+        self.annotations = annotations  # AnnotationStore shared by all the views (optional)
 
         # Configure slice plane
         self.reslice_axes = vtk.vtkMatrix4x4()
@@ -66,20 +688,27 @@ class MPRVisualizer:
         self.renderer.SetBackground(0.0, 0.0, 0.0)
 
         # Create VTK widget for the MPR views and interactor
-        self.widget = QVTKRenderWindowInteractor(self.parent_widget)
+        self.widget = create_render_widget(self.parent_widget, offscreen)
         self.widget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         self.widget.GetRenderWindow().AddRenderer(self.renderer)
 
         interactor = self.widget.GetRenderWindow().GetInteractor()
         interactor.SetInteractorStyle(vtk.vtkInteractorStyleImage())
 
-        self.set_slice_orientation(self.orientation)
-        self.set_initial_slice()
-        self.widget.GetRenderWindow().Render()
+        # above the memory budget, slices are resliced coarser while a slider is dragged
+        self.preview_factor = 1
 
         # set the parameter for the measurements
         self.distance_widget = None
+        self.angle_widget = None
+        self.distance_annotation = None
+        self.angle_annotation = None
         self.text_actor = None
+        self.annotation_overlay_setup()
+
+        self.set_slice_orientation(self.orientation)
+        self.set_initial_slice()
+        self.widget.GetRenderWindow().Render()
 
     def set_slice_orientation(self, orientation): #define the reslice_axis based on the orientation
         self.reslice_axes.Identity()
@@ -90,12 +719,20 @@ class MPRVisualizer:
         elif orientation == "sagittal":
             self.reslice_axes.DeepCopy((0, 0, -1, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1))
         self.reslice.SetResliceAxes(self.reslice_axes)
+
+        # default output spacing of the reslice (the CT spacing along each output axis), the base of the previews
+        axes = np.array([[self.reslice_axes.GetElement(row, col) for col in range(3)] for row in range(3)])
+        self.slice_spacing = np.sqrt(((axes * np.array(self.image_data.GetSpacing())[:, None]) ** 2).sum(axis=0))
         self.reslice.Update()
 
+    def slice_position(self, index): # world coordinate of the slice with this index along the slicing axis
+        slicing_axis = {"axial": 2, "coronal": 1, "sagittal": 0}[self.orientation]
+        return self.image_data.GetOrigin()[slicing_axis] + index * self.image_data.GetSpacing()[slicing_axis]
+
     def set_initial_slice(self): # define the initial slice to render in each MPR view: the middle one
         slicing_axis = {"axial": 2, "coronal": 1, "sagittal": 0}[self.orientation]
         origin = [0, 0, 0]
-        origin[slicing_axis] = self.image_data.GetDimensions()[slicing_axis] // 2
+        origin[slicing_axis] = self.slice_position(self.image_data.GetDimensions()[slicing_axis] // 2)
         self.reslice.SetResliceAxesOrigin(*origin)
         self.reslice.Update()
 
@@ -109,105 +746,505 @@ class MPRVisualizer:
         slider.setValue(max_slices // 2) # initial value of the slider
 
         slider.valueChanged.connect(self.update_slice) # update the slice based on the slider
+        slider.sliderPressed.connect(lambda: self.set_preview(True))
+        slider.sliderReleased.connect(lambda: self.set_preview(False))
         return slider
 
+    def set_preview(self, active): # downsampled reslicing (smaller buffers, faster) while interacting
+        if self.preview_factor <= 1:
+            return
+        if active:
+            self.reslice.SetOutputSpacing(*(self.slice_spacing * self.preview_factor))
+        else:
+            self.reslice.SetOutputSpacingToDefault()
+        self.reslice.Update()
+        self.widget.GetRenderWindow().Render()
+
     def update_slice(self, value):  # update the slice based on the slider
         slicing_axis = {"axial": 2, "coronal": 1, "sagittal": 0}[self.orientation]
         origin = [0, 0, 0]
-        origin[slicing_axis] = value - 1 
+        origin[slicing_axis] = self.slice_position(value - 1)
         self.reslice.SetResliceAxesOrigin(*origin)
         self.reslice.Update()
         self.widget.GetRenderWindow().Render()
+
+    def slice_to_world(self, point): # (x, y) in the resliced image -> 3D world point in the CT
+        return np.array(self.reslice.GetResliceAxes().MultiplyPoint((point[0], point[1], 0.0, 1.0))[:3])
     
-    ### Measuring Distance in Pixels
+    ### Measuring Distance in mm (world coordinates)
+    # one widget per measurement: its observers are registered once, the text update is throttled and the
+    # finished measurement is stored in the annotation store. turning the mode off hides the widget, the stored
+    # measurement stays drawn by the annotation overlay; the next one gets a new widget
 
     def toggle_distance_measurement(self):
-        if not self.distance_widget:
-            self.distance_widget = vtk.vtkDistanceWidget()
-            self.distance_widget.SetInteractor(self.widget.GetRenderWindow().GetInteractor())
-            self.distance_widget.CreateDefaultRepresentation()
-
-        if self.distance_widget.GetEnabled():
-            self.distance_widget.Off()  
+        if self.distance_widget and self.distance_widget.GetEnabled():
+            self.distance_widget.Off()
+            self.distance_widget = None
             if hasattr(self, 'distance_text_actor'):
                 self.distance_text_actor.SetInput("")  
             self.widget.GetRenderWindow().Render()  
-        else:
-            self.distance_widget.On()  
-
-            # Function to update the text at every interation with one screen
-            def update_distance(orientation):
-                distance_in_pixels = self.distance_widget.GetRepresentation().GetDistance()
-
-                # Get the spacing in mm
-                spacing = self.image_data.GetSpacing()
-                spacing_x, spacing_y, spacing_z = spacing
-
-                # Get the distance according to the axis
-                if orientation == 'axial':
-                    distance_in_mm = distance_in_pixels * spacing_z  # Z
-                elif orientation == 'sagittal':
-                    distance_in_mm = distance_in_pixels * spacing_x  # X (plan sagittal)
-                elif orientation == 'coronal':
-                    distance_in_mm = distance_in_pixels * spacing_y  # Y (plan coronal)
-                else:
-                    distance_in_mm = distance_in_pixels * spacing_x 
-
-                # Create a new text if necessary
-                if not hasattr(self, 'distance_text_actor'):
-                    self.distance_text_actor = vtk.vtkTextActor()
-                    self.distance_text_actor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
-                    self.distance_text_actor.GetPositionCoordinate().SetValue(0.05, 0.95)
-                    self.distance_text_actor.GetTextProperty().SetFontSize(15)
-                    self.distance_text_actor.GetTextProperty().SetColor(1.0, 1.0, 1.0)
-                    self.renderer.AddActor(self.distance_text_actor)
-
-                self.distance_text_actor.SetInput(f"Distance: {distance_in_mm:.2f} mm")
-                
-                self.widget.GetRenderWindow().Render()
-            self.distance_widget.AddObserver("InteractionEvent", lambda obj, event: update_distance(self.orientation))
-            self.widget.GetRenderWindow().Render()
+            return
+
+        self.distance_widget = vtk.vtkDistanceWidget()
+        self.distance_widget.SetInteractor(self.widget.GetRenderWindow().GetInteractor())
+        self.distance_widget.CreateDefaultRepresentation()
+        self.distance_annotation = None  # index in the annotation store once the measurement is placed
+
+        self.distance_widget.AddObserver("InteractionEvent", throttled(self.update_distance))
+        self.distance_widget.AddObserver("EndInteractionEvent", lambda obj, event: self.update_distance(register=True))
+        self.distance_widget.On()
+        self.widget.GetRenderWindow().Render()
+
+    # Function to update the text at every interation with one screen
+    def update_distance(self, register=False):
+        if not self.distance_widget:
+            return
+        # both end points are brought back to CT world coordinates, so anisotropic voxels are handled
+        point1, point2 = [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]
+        self.distance_widget.GetRepresentation().GetPoint1WorldPosition(point1)
+        self.distance_widget.GetRepresentation().GetPoint2WorldPosition(point2)
+        points = [self.slice_to_world(point1), self.slice_to_world(point2)]
+        distance_in_mm = world_distance(*points)
+
+        # Create a new text if necessary
+        if not hasattr(self, 'distance_text_actor'):
+            self.distance_text_actor = vtk.vtkTextActor()
+            self.distance_text_actor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
+            self.distance_text_actor.GetPositionCoordinate().SetValue(0.05, 0.95)
+            self.distance_text_actor.GetTextProperty().SetFontSize(15)
+            self.distance_text_actor.GetTextProperty().SetColor(1.0, 1.0, 1.0)
+            self.renderer.AddActor(self.distance_text_actor)
+
+        self.distance_text_actor.SetInput(f"Distance: {distance_in_mm:.2f} mm")
+
+        # the end of the first placement registers the measurement, later drags update it in place
+        if register and self.annotations is not None and self.distance_widget.GetWidgetState() == vtk.vtkDistanceWidget.Manipulate:
+            if self.distance_annotation is None:
+                self.distance_annotation = self.annotations.add("distance", self.orientation, distance_in_mm, points)
+            else:
+                self.annotations.update(self.distance_annotation, "distance", self.orientation, distance_in_mm, points)
+
+        self.widget.GetRenderWindow().Render()
 
 
     ### Measuring Angle in Degrees
 
     def toggle_angle_measurement(self):
-        if not hasattr(self, 'angle_widget'):
-            self.angle_widget = vtk.vtkAngleWidget()
-            self.angle_widget.SetInteractor(self.widget.GetRenderWindow().GetInteractor())
-            self.angle_widget.CreateDefaultRepresentation()
-
-        if self.angle_widget.GetEnabled():
+        if self.angle_widget and self.angle_widget.GetEnabled():
             self.angle_widget.Off()
+            self.angle_widget = None
             if hasattr(self, 'angle_text_actor'): 
                 self.angle_text_actor.SetInput("")  
             self.widget.GetRenderWindow().Render()
-        else:
-            self.angle_widget.On()
+            return
 
-            # Function to update the angle text at every interaction
-            def update_angle():
-                angle_in_degrees = self.angle_widget.GetRepresentation().GetAngle()
+        self.angle_widget = vtk.vtkAngleWidget()
+        self.angle_widget.SetInteractor(self.widget.GetRenderWindow().GetInteractor())
+        self.angle_widget.CreateDefaultRepresentation()
+        self.angle_annotation = None
 
-                # Create a new text actor if necessary
-                if not hasattr(self, 'angle_text_actor'): 
-                    self.angle_text_actor = vtk.vtkTextActor()
-                    self.angle_text_actor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
-                    self.angle_text_actor.GetPositionCoordinate().SetValue(0.50, 0.95)
-                    self.angle_text_actor.GetTextProperty().SetFontSize(15)
-                    self.angle_text_actor.GetTextProperty().SetColor(1.0, 1.0, 1.0)
-                    self.renderer.AddActor(self.angle_text_actor)
+        # Add the observers (once) to update the angle whenever there is an interaction
+        self.angle_widget.AddObserver("InteractionEvent", throttled(self.update_angle))
+        self.angle_widget.AddObserver("EndInteractionEvent", lambda obj, event: self.update_angle(register=True))
+        self.angle_widget.On()
+        self.widget.GetRenderWindow().Render()
 
-                # Update the text actor with the angle
-                self.angle_text_actor.SetInput(f"Angle: {angle_in_degrees:.2f}°")  # Renommer correctement
+    # Function to update the angle text at every interaction
+    def update_angle(self, register=False):
+        if not self.angle_widget:
+            return
+        point1, center, point2 = [0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]
+        self.angle_widget.GetRepresentation().GetPoint1WorldPosition(point1)
+        self.angle_widget.GetRepresentation().GetCenterWorldPosition(center)
+        self.angle_widget.GetRepresentation().GetPoint2WorldPosition(point2)
+        points = [self.slice_to_world(point1), self.slice_to_world(center), self.slice_to_world(point2)]
+        angle_in_degrees = world_angle(*points)
+
+        # Create a new text actor if necessary
+        if not hasattr(self, 'angle_text_actor'): 
+            self.angle_text_actor = vtk.vtkTextActor()
+            self.angle_text_actor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
+            self.angle_text_actor.GetPositionCoordinate().SetValue(0.50, 0.95)
+            self.angle_text_actor.GetTextProperty().SetFontSize(15)
+            self.angle_text_actor.GetTextProperty().SetColor(1.0, 1.0, 1.0)
+            self.renderer.AddActor(self.angle_text_actor)
+
+        # Update the text actor with the angle
+        self.angle_text_actor.SetInput(f"Angle: {angle_in_degrees:.2f}°")
+
+        if register and self.annotations is not None and self.angle_widget.GetWidgetState() == vtk.vtkAngleWidget.Manipulate:
+            if self.angle_annotation is None:
+                self.angle_annotation = self.annotations.add("angle", self.orientation, angle_in_degrees, points)
+            else:
+                self.annotations.update(self.angle_annotation, "angle", self.orientation, angle_in_degrees, points)
 
-                self.widget.GetRenderWindow().Render()
+        self.widget.GetRenderWindow().Render()
 
-            # Add an observer to update the angle whenever there is an interaction
-            self.angle_widget.AddObserver("InteractionEvent", lambda obj, event: update_angle())
+    ### Stored measurements of this view, drawn (read-only) on the slice they were made on
+
+    def annotation_overlay_setup(self):
+        coordinate = vtk.vtkCoordinate()
+        coordinate.SetCoordinateSystemToWorld()
+        self.overlay_lines = vtk.vtkPolyData()
+        line_mapper = vtk.vtkPolyDataMapper2D()  # 2D: always on top of the slice
+        line_mapper.SetInputData(self.overlay_lines)
+        line_mapper.SetTransformCoordinate(coordinate)
+        self.overlay_line_actor = vtk.vtkActor2D()
+        self.overlay_line_actor.SetMapper(line_mapper)
+        self.overlay_line_actor.GetProperty().SetColor(1.0, 1.0, 0.0)  # Yellow
+
+        self.overlay_labels = vtk.vtkPolyData()
+        label_mapper = vtk.vtkLabeledDataMapper()
+        label_mapper.SetInputData(self.overlay_labels)
+        label_mapper.SetLabelModeToLabelFieldData()
+        label_mapper.SetFieldDataName("label")
+        label_mapper.GetLabelTextProperty().SetFontSize(13)
+        label_mapper.GetLabelTextProperty().SetColor(1.0, 1.0, 0.0)
+        self.overlay_label_actor = vtk.vtkActor2D()
+        self.overlay_label_actor.SetMapper(label_mapper)
+
+        self.renderer.AddActor(self.overlay_line_actor)
+        self.renderer.AddActor(self.overlay_label_actor)
+        self.overlay_key = None
+        self.renderer.AddObserver("StartEvent", self.update_annotation_overlay)
+
+    def update_annotation_overlay(self, obj=None, event=None): # before each render, only rebuilt when something changed
+        if self.annotations is None:
+            return
+        # measurements being edited are drawn by their widget
+        editing = [
+            index for widget, index in ((self.distance_widget, self.distance_annotation), (self.angle_widget, self.angle_annotation))
+            if widget is not None and widget.GetEnabled() and index is not None
+        ]
+        reslice_axes = self.reslice.GetResliceAxes()
+        axes = np.array([[reslice_axes.GetElement(row, col) for col in range(4)] for row in range(4)])
+        key = (tuple(axes.ravel()), self.annotations.revision, tuple(editing))
+        if key == self.overlay_key:
+            return
+        self.overlay_key = key
+
+        # world points -> resliced image coordinates (inverse of slice_to_world); z is the distance to the slice
+        count = len(self.annotations)
+        slice_points = (self.annotations.points[:count] - axes[:3, 3]) @ axes[:3, :3]
+        slicing_axis = {"axial": 2, "coronal": 1, "sagittal": 0}[self.orientation]
+        half_slice = self.image_data.GetSpacing()[slicing_axis] / 2
+        on_slice = self.annotations.views[:count] == ANNOTATION_VIEWS.index(self.orientation)
+        on_slice &= np.all(np.isnan(slice_points[:, :, 2]) | (np.abs(slice_points[:, :, 2]) <= half_slice), axis=1)
+        on_slice[editing] = False
+
+        points, lines = vtk.vtkPoints(), vtk.vtkCellArray()
+        label_points, labels = vtk.vtkPoints(), vtk.vtkStringArray()
+        labels.SetName("label")
+        for index in np.flatnonzero(on_slice):
+            coordinates = slice_points[index][~np.isnan(slice_points[index, :, 0])]
+            coordinates[:, 2] = 0.0
+            lines.InsertNextCell(len(coordinates), [points.InsertNextPoint(*point) for point in coordinates])
+            # distance: label in the middle, angle: label on the vertex
+            anchor = coordinates.mean(axis=0) if len(coordinates) == 2 else coordinates[1]
+            label_points.InsertNextPoint(*anchor)
+            labels.InsertNextValue(self.annotations.describe(index))
+
+        self.overlay_lines.Initialize()
+        self.overlay_lines.SetPoints(points)
+        self.overlay_lines.SetLines(lines)
+        self.overlay_labels.Initialize()
+        self.overlay_labels.SetPoints(label_points)
+        self.overlay_labels.GetPointData().AddArray(labels)
+
+
+
+
+
+# PICKING ON THE 3D SURFACES
+# one vtkStaticCellLocator per mesh, built on the first pick and only rebuilt when the mesh changes (cuts).
+# meshes are kept in their local coordinates: the ray is moved into the mesh frame, so moving the implant costs nothing
+
+class SurfacePicker:
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.meshes = {}  # name -> (polydata, prop placing it in the world or None)
+        self.locators = {}
+        self.clipping_plane = None  # hits on the clipped side of the cut are ignored
+
+    def set_mesh(self, name, polydata, prop=None):
+        self.meshes[name] = (polydata, prop)
+        self.locators.pop(name, None)  # rebuilt on the next pick
+
+    def get_locator(self, name):
+        if name not in self.locators:
+            locator = vtk.vtkStaticCellLocator()
+            locator.SetDataSet(self.meshes[name][0])
+            locator.BuildLocator()
+            self.locators[name] = locator
+        return self.locators[name]
+
+    def display_ray(self, x, y): # world points on the near and far clipping planes under the display position
+        ray = []
+        for depth in (0.0, 1.0):
+            self.renderer.SetDisplayPoint(x, y, depth)
+            self.renderer.DisplayToWorld()
+            point = self.renderer.GetWorldPoint()
+            ray.append(np.array(point[:3]) / point[3])
+        return ray
+
+    def pick(self, x, y): # nearest visible surface point under (x, y): (mesh name, world point) or (None, None)
+        near, far = self.display_ray(x, y)
+        best_name, best_point, best_distance = None, None, np.inf
+
+        for name, (polydata, prop) in self.meshes.items():
+            if prop is not None and not prop.GetVisibility():
+                continue
+            to_world = np.eye(4)
+            if prop is not None:
+                matrix = prop.GetMatrix()
+                to_world = np.array([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+            to_local = np.linalg.inv(to_world)
+
+            # small tolerance: with 0 the locator misses faces lying exactly on the mesh bounds
+            hits = vtk.vtkPoints()
+            cell_ids = vtk.vtkIdList()
+            self.get_locator(name).IntersectWithLine(
+                (to_local @ np.append(near, 1.0))[:3], (to_local @ np.append(far, 1.0))[:3], 1e-3, hits, cell_ids
+            )
+            for i in range(hits.GetNumberOfPoints()):
+                point = (to_world @ np.append(hits.GetPoint(i), 1.0))[:3]
+                if self.clipping_plane is not None and self.clipping_plane.EvaluateFunction(point) < 0:
+                    continue
+                distance = np.linalg.norm(point - near)
+                if distance < best_distance:
+                    best_name, best_point, best_distance = name, point, distance
+
+        return best_name, best_point
+
+
+
+# 3D MEASUREMENTS: distance (2 points) and angle (3 points, vertex in the middle) picked on the surfaces
+
+class SurfaceMeasurementTool:
+    def __init__(self, widget, renderer, picker, annotations=None):
+        self.widget = widget
+        self.renderer = renderer
+        self.picker = picker
+        self.annotations = annotations  # finished measurements are registered here (optional)
+        self.result_text = ""
+        self.mode = None  # None, "distance" or "angle"
+        self.points = []
+        self.hover_point = None
+        self.previous_style = None
+
+        # interactor style used while measuring: left click places points, the other buttons still pan / zoom
+        self.style = vtk.vtkInteractorStyleTrackballCamera()
+        self.style.AddObserver("LeftButtonPressEvent", self.on_left_button_press)
+        self.style.AddObserver("MouseMoveEvent", self.on_mouse_move)
+
+        # polyline through the placed points (and the hovered one)
+        self.line_source = vtk.vtkLineSource()
+        line_mapper = vtk.vtkPolyDataMapper()
+        line_mapper.SetInputConnection(self.line_source.GetOutputPort())
+        self.line_actor = vtk.vtkActor()
+        self.line_actor.SetMapper(line_mapper)
+        self.line_actor.GetProperty().SetColor(0.2, 1.0, 0.2)
+        self.line_actor.GetProperty().SetLineWidth(3)
+        self.line_actor.VisibilityOff()
+
+        # marker on the surface under the mouse
+        self.marker_source = vtk.vtkSphereSource()
+        self.marker_source.SetRadius(2.0)
+        marker_mapper = vtk.vtkPolyDataMapper()
+        marker_mapper.SetInputConnection(self.marker_source.GetOutputPort())
+        self.marker_actor = vtk.vtkActor()
+        self.marker_actor.SetMapper(marker_mapper)
+        self.marker_actor.GetProperty().SetColor(0.2, 1.0, 0.2)
+        self.marker_actor.VisibilityOff()
+
+        self.text_actor = vtk.vtkTextActor()
+        self.text_actor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
+        self.text_actor.GetPositionCoordinate().SetValue(0.05, 0.95)
+        self.text_actor.GetTextProperty().SetFontSize(15)
+        self.text_actor.GetTextProperty().SetColor(1.0, 1.0, 1.0)
+
+        for actor in (self.line_actor, self.marker_actor, self.text_actor):
+            self.renderer.AddActor(actor)
+
+    def points_needed(self):
+        return {"distance": 2, "angle": 3}[self.mode]
+
+    def set_mode(self, mode): # switch measuring on (distance / angle) or off (None)
+        interactor = self.widget.GetRenderWindow().GetInteractor()
+        if mode and not self.mode:
+            self.previous_style = interactor.GetInteractorStyle()
+            interactor.SetInteractorStyle(self.style)
+        elif not mode and self.mode:
+            interactor.SetInteractorStyle(self.previous_style)
+        self.mode = mode
+        self.points = []
+        self.hover_point = None
+        self.result_text = ""
+        self.text_actor.SetInput("")
+        self.update_actors()
+        self.widget.GetRenderWindow().Render()
+
+    def on_mouse_move(self, obj, event):
+        if obj.GetState() != vtk.VTKIS_NONE:  # panning / zooming: the style renders, no picking while the camera moves
+            obj.OnMouseMove()
+            return
+
+        x, y = self.widget.GetRenderWindow().GetInteractor().GetEventPosition()
+        _, hover_point = self.picker.pick(x, y)
+
+        # hovering a stored annotation shows it, otherwise the last result stays on screen
+        hits = []
+        if self.annotations is not None and hover_point is not None:
+            hits = self.annotations.hit_test(hover_point, radius=3.0)
+        text = self.annotations.describe(hits[0]) if hits else self.result_text
+
+        # only render when the marker or the text changed
+        moved = (hover_point is None) != (self.hover_point is None) or (
+            hover_point is not None and not np.array_equal(hover_point, self.hover_point)
+        )
+        if moved or text != self.text_actor.GetInput():
+            self.hover_point = hover_point
+            self.text_actor.SetInput(text)
+            self.update_actors()
             self.widget.GetRenderWindow().Render()
 
+    def on_left_button_press(self, obj, event):
+        x, y = self.widget.GetRenderWindow().GetInteractor().GetEventPosition()
+        _, point = self.picker.pick(x, y)
+        if point is None:
+            return
+        if len(self.points) == self.points_needed():
+            self.points = []  # previous measurement done: start a new one
+        self.points.append(point)
+
+        if len(self.points) == self.points_needed():
+            if self.mode == "distance":
+                value = world_distance(*self.points)
+                self.result_text = f"3D Distance: {value:.2f} mm"
+            else:
+                value = world_angle(*self.points)
+                self.result_text = f"3D Angle: {value:.2f}°"
+            self.text_actor.SetInput(self.result_text)
+            if self.annotations is not None:
+                self.annotations.add(self.mode, "3d", value, self.points)
+        self.update_actors()
+        self.widget.GetRenderWindow().Render()
 
+    def update_actors(self):
+        shown = list(self.points)
+        if self.hover_point is not None and self.mode and len(shown) < self.points_needed():
+            shown.append(self.hover_point)
+
+        if len(shown) >= 2:
+            line_points = vtk.vtkPoints()
+            for point in shown:
+                line_points.InsertNextPoint(point)
+            self.line_source.SetPoints(line_points)
+            self.line_actor.VisibilityOn()
+        else:
+            self.line_actor.VisibilityOff()
+
+        if self.mode and self.hover_point is not None:
+            self.marker_source.SetCenter(*self.hover_point)
+            self.marker_actor.VisibilityOn()
+        else:
+            self.marker_actor.VisibilityOff()
+
+
+
+# ADAPTIVE QUALITY of the 3D view: cheaper volume rendering while interacting / animating, full quality when idle.
+# the target frame time is the one an animation asks for, else the desired update rate of the interactor (the gaps
+# between mouse events cannot be used: rendering blocks the event loop, so they are never shorter than a render);
+# the reduction level is then scaled from the measured render times
+
+class AdaptiveQualityController:
+    MAX_LEVEL = 16.0  # at most 4x coarser ray sampling and 2x coarser image sampling
+
+    def __init__(self, renderer, volume, interactor):
+        self.renderer = renderer
+        self.interactor = interactor
+        self.mapper = volume.GetMapper()
+        self.volume_property = volume.GetProperty()
+
+        # full quality = the settings the volume was built with
+        self.full_quality = (
+            self.mapper.GetAutoAdjustSampleDistances(), self.mapper.GetSampleDistance(),
+            self.mapper.GetImageSampleDistance(), self.volume_property.GetShade(),
+        )
+        self.base_sample_distance = min(self.mapper.GetInput().GetSpacing()) / 2
+
+        self.level = 1.0  # render cost is ~ 1 / level; kept from one interaction to the next
+        self.interactive = False
+        self.target_frame_time = None
+        self.full_render_time = None  # moving average of the full quality render times
+        self.last_render_time = 0.0
+
+        self.idle_timer = QTimer()
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.timeout.connect(self.restore_full_quality)
+
+        self.renderer.AddObserver("EndEvent", self.on_render_end)
+
+        # mouse camera moves; observers on the interactor so they survive interactor style changes
+        self.buttons_down = 0
+        for button in ("Left", "Middle", "Right"):
+            interactor.AddObserver(f"{button}ButtonPressEvent", self.on_button_press, 1.0)
+            interactor.AddObserver(f"{button}ButtonReleaseEvent", self.on_button_release, 1.0)
+        interactor.AddObserver("MouseMoveEvent", self.on_mouse_move, 1.0)
+        interactor.AddObserver("MouseWheelForwardEvent", lambda obj, event: self.interaction(), 1.0)
+        interactor.AddObserver("MouseWheelBackwardEvent", lambda obj, event: self.interaction(), 1.0)
+
+    def on_button_press(self, obj, event):
+        self.buttons_down += 1
+        self.interaction()
+
+    def on_button_release(self, obj, event):
+        self.buttons_down = max(0, self.buttons_down - 1)
+
+    def on_mouse_move(self, obj, event):
+        if self.buttons_down:
+            self.interaction()
+
+    def interaction(self, frame_time=None): # call before an interactive render (frame_time: pace asked by an animation)
+        if frame_time is None:
+            frame_time = 1.0 / self.interactor.GetDesiredUpdateRate()
+        self.target_frame_time = frame_time
+
+        # only degrade when full quality cannot keep the pace
+        if not self.interactive and self.full_render_time and self.full_render_time > self.target_frame_time:
+            self.interactive = True
+            self.apply_level()
+
+        # back to full quality after a few frames without interaction
+        idle = 3 * max(self.target_frame_time, self.last_render_time, 0.05)
+        self.idle_timer.start(int(1000 * idle))
+
+    def on_render_end(self, obj, event):
+        render_time = self.renderer.GetLastRenderTimeInSeconds()
+        self.last_render_time = render_time
+        if self.interactive:
+            # next frame: scale the reduction so that the render time meets the target
+            self.level = min(max(self.level * render_time / self.target_frame_time, 1.0), self.MAX_LEVEL)
+            self.apply_level()
+        else:
+            self.full_render_time = render_time if self.full_render_time is None else 0.8 * self.full_render_time + 0.2 * render_time
+
+    def apply_level(self): # cost split between the ray sampling (sqrt) and the image sampling (pixels ~ 1 / sqrt)
+        self.mapper.SetAutoAdjustSampleDistances(0)
+        self.mapper.SetSampleDistance(self.base_sample_distance * self.level ** 0.5)
+        self.mapper.SetImageSampleDistance(self.level ** 0.25)
+        self.volume_property.ShadeOff()
+
+    def restore_full_quality(self):
+        if not self.interactive:
+            return
+        self.interactive = False
+        auto_adjust, sample_distance, image_sample_distance, shade = self.full_quality
+        self.mapper.SetAutoAdjustSampleDistances(auto_adjust)
+        self.mapper.SetSampleDistance(sample_distance)
+        self.mapper.SetImageSampleDistance(image_sample_distance)
+        self.volume_property.SetShade(shade)
+        self.renderer.GetRenderWindow().Render()
 
 
 
@@ -215,12 +1252,17 @@ class MPRVisualizer:
 #this is mainly divided in 2 parts: (1) the MPR visualization of the image slices and (2) the 3d view corner with the bones and prosthesis
 
 class HipReplacementApp(QMainWindow):
-    def __init__(self, image_path, mask_path, prosthesis_path, side):
+    def __init__(self, image_path, mask_path, prosthesis_path, side, memory_budget_mb=MEMORY_BUDGET_MB, offscreen=False):
         super().__init__()
         self.image_path = image_path  # CT image
-        self.mask_path = mask_path  # segmentation mask
+        self.mask_path = mask_path  # segmentation mask (None: generated from the CT)
         self.prosthesis_path = prosthesis_path  # prosthesis model
         self.side = side
+        self.memory = MemoryMonitor(memory_budget_mb)
+        self.offscreen = offscreen  # render server: same pipeline, offscreen render windows
+
+        # measurements of this case (2D and 3D), saved on close
+        self.annotations = AnnotationStore.load(annotation_path(self.image_path))
 
         self.setWindowTitle("Orthopedic Surgery Visualization")
         self.setGeometry(150, 150, 2000, 1600)
@@ -234,6 +1276,7 @@ class HipReplacementApp(QMainWindow):
         self.frame.setLayout(self.layout)
 
         self.mpr_views = {} #dictionary to store the multi-planar reconstruction views
+        self.sliders = {} # and their sliders
 
         # Varaible for measures
             #2d slices
@@ -246,24 +1289,61 @@ class HipReplacementApp(QMainWindow):
 
         self.create_slice_view()
 
+        # reopen the case where it was left
+        self.restore_session()
+
 
     def create_slice_view(self): 
         nifti_reader = vtk.vtkNIFTIImageReader()
         nifti_reader.SetFileName(self.image_path)
         nifti_reader.Update()
 
+        self.nifti_reader = nifti_reader  # kept for the rescale slope / orientation of the CT
         self.image_data = nifti_reader.GetOutput()
+        self.memory.measure("CT image")
+        self.estimate_memory()
 
         for i, (plane, row, col) in enumerate(
             [("axial", 0, 0), ("coronal", 0, 1), ("sagittal", 1, 0)]
         ):
-            mpr_visualizer = MPRVisualizer(self.image_data, plane, self.frame)  # Create MPRVisualizer instance 
+            mpr_visualizer = MPRVisualizer(self.image_data, plane, self.frame, self.annotations, self.offscreen)  # Create MPRVisualizer instance 
             slider = mpr_visualizer.create_slider()  # Get the slider to update the slices correspondingly
             self.layout.addWidget(mpr_visualizer.widget, row * 2, col)  
             self.layout.addWidget(slider, row * 2 + 1, col) 
             self.mpr_views[plane] = mpr_visualizer
+            self.sliders[plane] = slider
+            mpr_visualizer.preview_factor = self.volume_downsampling
+        self.memory.measure("MPR views")
 
         self.init_3d_view()
+        self.memory.report()
+
+
+    def estimate_memory(self): # footprint of each stage before building it, decides the 3D volume downsampling
+        voxels = self.image_data.GetNumberOfPoints()
+        nx, ny, nz = self.image_data.GetDimensions()
+        megabyte = 2**20
+
+        # the mask is on the CT grid; its scalar type is read from the header when the file already exists
+        mask_bytes = 1
+        if self.mask_path:
+            header = vtk.vtkNIFTIImageReader()
+            header.SetFileName(self.mask_path)
+            header.UpdateInformation()
+            mask_bytes = vtk.vtkDataArray.GetDataTypeSize(header.GetDataScalarType())
+
+        # each MPR view: resliced slice + RGBA window/level output + RGBA texture
+        largest_slice = max(nx * ny, nx * nz, ny * nz)
+        slice_bytes = self.image_data.GetScalarSize() + 4 + 4
+
+        self.memory.estimate("CT image", self.image_data.GetActualMemorySize() / 1024)
+        self.memory.estimate("MPR views", 3 * largest_slice * slice_bytes / megabyte)
+        self.memory.estimate("mask", voxels * mask_bytes / megabyte)
+        self.memory.estimate("3D volume", VOLUME_RENDERING_OVERHEAD * voxels * mask_bytes / megabyte)
+
+        self.volume_downsampling = self.memory.downsampling_factor("3D volume")
+        if self.volume_downsampling > 1:
+            print(f"Above the {self.memory.budget_mb} MB budget: 3D volume and slice previews downsampled {self.volume_downsampling}x per axis.")
 
     
  
@@ -300,48 +1380,151 @@ class HipReplacementApp(QMainWindow):
 
         self.prosthesis_actor = vtk.vtkActor()
         self.prosthesis_actor.SetMapper(self.prosthesis_mapper)
-        self.prosthesis_actor.SetScale(scale_factor, scale_factor, scale_factor)
         self.prosthesis_actor.GetProperty().SetColor(1.0, 0.5, 0.0)  # Orange
         self.prosthesis_actor.GetProperty().SetOpacity(1.0)  # Fully opaque
 
         # Prosthesis Transformation Based on Side
-        self.prosthesis_transform = vtk.vtkTransform()
-
-        if self.side == "Right":
-            print('Right chosen')
-            # Translation adjustment
-            self.prosthesis_transform.Translate(58, 145, 68)  # Fine-tuned translation closer to the joint
-
-            # Rotation adjustments
-            self.prosthesis_transform.RotateWXYZ(90, 0, 1, 0)   # Flip around the Y-axis (kept as-is)
-            self.prosthesis_transform.RotateWXYZ(85, 1, 0, 0)   # Refined rotation along X-axis for ball position
-            self.prosthesis_transform.RotateWXYZ(-45, 0, 0, 1)  # Adjust Z-axis rotation for shaft alignment
-            self.prosthesis_transform.RotateWXYZ(20, -1, -0.2, 0)  # Minor tilt correction
-            self.prosthesis_transform.RotateWXYZ(15, 0, 0, 1)   # Small Z-axis fine-tuning
-            
+        print(f'{self.side} chosen')
+        self.prosthesis_transform = side_transform(self.side)
 
-        elif self.side == "Left":
-            print("Left chosen")
-            self.prosthesis_transform.Translate(280, 165, 30)
-            self.prosthesis_transform.RotateWXYZ(-90, 1, 0, 0)
-            self.prosthesis_transform.RotateWXYZ(45, 0, 1, 1)
-            self.prosthesis_transform.RotateWXYZ(-30, 0, 1, 0)
-        
-        # Apply the transformation
-        self.prosthesis_actor.SetUserTransform(self.prosthesis_transform)
+        # Initial pose: every later change goes through set_implant_pose and the undo / redo history
+        self.implant_pose = ImplantPose.from_transform(self.prosthesis_transform, scale_factor)
+        self.pose_history = PoseHistory(self.implant_pose)
+        self.prosthesis_actor.SetUserMatrix(self.implant_pose.matrix())
+
+
+    def set_implant_pose(self, pose, record=True): # move the implant; record=False for undo / redo
+        self.implant_pose = pose
+        if record:
+            self.pose_history.push(pose)
+        self.prosthesis_actor.SetUserMatrix(pose.matrix())
+        self.quality.interaction()
+        self.renderer.GetRenderWindow().Render()
+
+
+    def export_plan_setup(self): # button to save the planned implant on the CT grid (NIfTI)
+        self.export_plan_button = QPushButton("Export Plan", self.frame)
+        self.export_plan_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+
+        def export():
+            start = time.perf_counter()
+            mask_path, fused_path = export_plan(
+                self.prosthesis_reader.GetOutput(), self.prosthesis_actor.GetMatrix(), self.nifti_reader, self.image_path
+            )
+            print(f"Plan exported in {time.perf_counter() - start:.2f} s: {mask_path}, {fused_path}")
+
+        self.export_plan_button.clicked.connect(export)
+
+
+    def compare_plans_setup(self): # button to open other implants / sides side by side with the current plan
+        self.compare_plans_button = QPushButton("Compare Plans", self.frame)
+        self.compare_plans_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.compare_plans_button.clicked.connect(self.open_comparison)
+
+
+    def open_comparison(self):
+        paths, _ = QFileDialog.getOpenFileNames(None, "Choose Prosthesis Files to Compare", "", "STL Files (*.stl)")
+        if not paths:
+            return
+        side, ok = QInputDialog.getItem(None, "Select Side", "Sides to compare:", ["Right", "Left", "Both"], 0, False)
+        if not ok:
+            return
+
+        sides = ["Right", "Left"] if side == "Both" else [side]
+        plans = [("Current plan", self.prosthesis_reader.GetOutput(), self.implant_pose)]
+        plans += self.comparison_plans(paths, sides)
+        self.comparison = PlanComparisonWindow(self, plans, self.offscreen)
+        self.comparison.show()
+
+
+    def comparison_plans(self, prosthesis_paths, sides): # [(name, implant mesh, initial pose)] for every implant / side
+        plans = []
+        for path in prosthesis_paths:
+            mesh = self.implant_mesh(path)
+            scale_factor = self.normalize_units(self.mask_reader.GetOutput(), mesh)
+            for side in sides:
+                pose = ImplantPose.from_transform(side_transform(side), scale_factor)
+                plans.append((f"{os.path.basename(path)} ({side})", mesh, pose))
+        return plans
+
+
+    def implant_mesh(self, path): # each implant file is read once, all the plans using it share the mesh
+        if not hasattr(self, 'implant_meshes'):
+            self.implant_meshes = {os.path.abspath(self.prosthesis_path): self.prosthesis_reader.GetOutput()}
+        key = os.path.abspath(path)
+        if key not in self.implant_meshes:
+            reader = vtk.vtkSTLReader()
+            reader.SetFileName(path)
+            reader.Update()
+            self.implant_meshes[key] = reader.GetOutput()
+        return self.implant_meshes[key]
+
+
+    def cropped_mask(self): # 3D volume input cropped to the bones, computed once (shared by the comparison views)
+        if not hasattr(self, 'cropped_mask_data'):
+            volume_input = self.volume_mapper.GetInput()
+            mask = image_to_array(volume_input)
+            extent = volume_input.GetExtent()
+            voi = []
+            for axis, other_axes in ((0, (0, 1)), (1, (0, 2)), (2, (1, 2))):  # numpy axes are (z, y, x)
+                indices = np.flatnonzero(mask.any(axis=other_axes))
+                if len(indices) == 0:  # empty mask: nothing to crop
+                    voi += [extent[2 * axis], extent[2 * axis + 1]]
+                else:
+                    voi += [extent[2 * axis] + indices[0], extent[2 * axis] + indices[-1]]
+
+            crop = vtk.vtkExtractVOI()
+            crop.SetInputData(volume_input)
+            crop.SetVOI(*[int(i) for i in voi])
+            crop.Update()
+            self.cropped_mask_data = crop.GetOutput()
+        return self.cropped_mask_data
+
+
+    def pose_history_buttons(self, widget): # undo / redo of the implant moves (also Ctrl+Z / Ctrl+Shift+Z)
+        self.undo_pose_button = QPushButton("Undo Move", self.frame)
+        self.redo_pose_button = QPushButton("Redo Move", self.frame)
+
+        self.undo_pose_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.redo_pose_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+
+        def undo_pose():
+            pose = self.pose_history.undo()
+            if pose is not None:
+                self.set_implant_pose(pose, record=False)
+
+        def redo_pose():
+            pose = self.pose_history.redo()
+            if pose is not None:
+                self.set_implant_pose(pose, record=False)
+
+        self.undo_pose_button.clicked.connect(undo_pose)
+        self.redo_pose_button.clicked.connect(redo_pose)
+        QShortcut(QKeySequence.Undo, self).activated.connect(undo_pose)
+        QShortcut(QKeySequence.Redo, self).activated.connect(redo_pose)
 
 
 
     def mask_rendering(self):
         # BONES MASK RENDERING
+        # No mask given: segment the bones from the CT (cached on disk, so only the first run pays for it)
+        if not self.mask_path:
+            self.mask_path = generate_bone_mask(self.nifti_reader, self.image_path)
+
         # Volume Rendering for Segmentation (Mask)
         self.mask_reader = vtk.vtkNIFTIImageReader()
         self.mask_reader.SetFileName(self.mask_path)
         self.mask_reader.Update()
+        self.memory.measure("mask")
 
         # Volume mapper for the hip bones segmentation mask
         self.volume_mapper = vtk.vtkGPUVolumeRayCastMapper()
-        self.volume_mapper.SetInputConnection(self.mask_reader.GetOutputPort())
+        if self.volume_downsampling > 1:
+            # above the memory budget: keep the max of each block so thin cortical bone does not vanish
+            self.volume_shrink = downsample_volume(self.mask_reader.GetOutput(), self.volume_downsampling)
+            self.volume_mapper.SetInputConnection(self.volume_shrink.GetOutputPort())
+        else:
+            self.volume_mapper.SetInputConnection(self.mask_reader.GetOutputPort())
 
         # Volume properties (color transfer functions)
         volume_color = vtk.vtkColorTransferFunction()
@@ -404,15 +1587,7 @@ class HipReplacementApp(QMainWindow):
         self.scale_down_button.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
 
         def scaling_prosthesis(scale_factor):
-
-            current_scale = self.prosthesis_actor.GetScale()
-            new_scale = (
-                current_scale[0] * scale_factor,
-                current_scale[1] * scale_factor,
-                current_scale[2] * scale_factor
-            )
-            self.prosthesis_actor.SetScale(new_scale)
-            widget.GetRenderWindow().Render() 
+            self.set_implant_pose(self.implant_pose.scaled(scale_factor))
 
         self.scale_up_button.clicked.connect(lambda: scaling_prosthesis(1.1))  # Scale up by 10%
         self.scale_down_button.clicked.connect(lambda: scaling_prosthesis(0.9)) 
@@ -437,6 +1612,7 @@ class HipReplacementApp(QMainWindow):
         # Create vtkPlane for volume and prosthesis clipping
         self.cutting_plane = vtk.vtkPlane()
         self.plane_widget.GetPlane(self.cutting_plane)  # Get initial plane position
+        self.cut_active = False
 
 
 
@@ -469,6 +1645,10 @@ class HipReplacementApp(QMainWindow):
             self.prosthesis_mapper.RemoveAllClippingPlanes()
             self.prosthesis_mapper.AddClippingPlane(self.cutting_plane)
 
+            # Picking must follow the cut
+            self.clip_picking_meshes(self.cutting_plane)
+            self.cut_active = True
+
             # Re-render
             widget.GetRenderWindow().Render()
 
@@ -483,6 +1663,8 @@ class HipReplacementApp(QMainWindow):
             # Reset volume clipping
             self.volume_mapper.RemoveAllClippingPlanes()
             self.prosthesis_mapper.RemoveAllClippingPlanes()
+            self.clip_picking_meshes(None)
+            self.cut_active = False
 
             # Re-render
             widget.GetRenderWindow().Render()
@@ -491,6 +1673,59 @@ class HipReplacementApp(QMainWindow):
     
     
 
+    def bone_surface(self): # bone surface extracted once from the mask (the 3D view shows a volume, picking needs a mesh)
+        if not hasattr(self, 'bone_surface_data'):
+            surface = vtk.vtkFlyingEdges3D()
+            surface.SetInputConnection(self.mask_reader.GetOutputPort())
+            surface.SetValue(0, 0.5)
+            surface.ComputeNormalsOff()
+            surface.ComputeGradientsOff()
+            surface.Update()
+            self.bone_surface_data = surface.GetOutput()
+        return self.bone_surface_data
+
+
+    def surface_measurement_setup(self, widget): # 3D distance / angle measurements on the bone and implant surfaces
+        self.surface_picker = SurfacePicker(self.renderer)
+        self.surface_measurement = SurfaceMeasurementTool(widget, self.renderer, self.surface_picker, self.annotations)
+        self.surface_meshes_ready = False  # meshes and locators are only built when a 3D measurement is first used
+
+        self.distance_3d_button = QPushButton("3D Distance", self.frame)
+        self.distance_3d_button.clicked.connect(lambda: self.toggle_surface_measurement_mode("distance"))
+        self.angle_3d_button = QPushButton("3D Angle", self.frame)
+        self.angle_3d_button.clicked.connect(lambda: self.toggle_surface_measurement_mode("angle"))
+
+
+    def clip_picking_meshes(self, plane): # keep picking consistent with the cut (None: no cut)
+        # the bone mesh is clipped and its locator rebuilt; the implant moves, so its hits are filtered against the plane
+        self.surface_picker.clipping_plane = plane
+        if not self.surface_meshes_ready:
+            return
+        if plane is None:
+            self.surface_picker.set_mesh("bone", self.bone_surface())
+        else:
+            clipper = vtk.vtkClipPolyData()
+            clipper.SetInputData(self.bone_surface())
+            clipper.SetClipFunction(plane)
+            clipper.Update()
+            self.surface_picker.set_mesh("bone", clipper.GetOutput())
+
+
+    def toggle_surface_measurement_mode(self, mode):
+        if not self.surface_meshes_ready:
+            self.surface_meshes_ready = True
+            self.surface_picker.set_mesh("prosthesis", self.prosthesis_reader.GetOutput(), self.prosthesis_actor)
+            self.clip_picking_meshes(self.surface_picker.clipping_plane)
+
+        new_mode = None if self.surface_measurement.mode == mode else mode
+        self.surface_measurement.set_mode(new_mode)
+
+        self.distance_3d_button.setStyleSheet("background-color: green; color: white;" if new_mode == "distance" else "")
+        self.distance_3d_button.setText("3D Distance: ON" if new_mode == "distance" else "3D Distance")
+        self.angle_3d_button.setStyleSheet("background-color: blue; color: white;" if new_mode == "angle" else "")
+        self.angle_3d_button.setText("3D Angle: ON" if new_mode == "angle" else "3D Angle")
+
+
     def mpr_slice_updates(self): # function that can change image slices in the mpr view depending on plane widget
         def update_slices(widget, event):
             slicing_origin = [0.0, 0.0, 0.0]
@@ -511,26 +1746,14 @@ class HipReplacementApp(QMainWindow):
         translation_step = 5  # Step size for translation
         rotation_step = 5     # Step size for rotation in degrees
 
-        # Helper functions for translation and rotation
+        axes = {'x': (1, 0, 0), 'y': (0, 1, 0), 'z': (0, 0, 1)}
+
+        # Helper functions for translation and rotation (along the implant axes)
         def translate(axis, step):
-            #self.prosthesis_transform.Identity()
-            if axis == 'x': 
-                self.prosthesis_transform.Translate(step, 0, 0)
-            elif axis == 'y':
-                self.prosthesis_transform.Translate(0, step, 0)
-            elif axis == 'z': 
-                self.prosthesis_transform.Translate(0, 0, step)
-            widget.GetRenderWindow().Render()
+            self.set_implant_pose(self.implant_pose.translated(np.multiply(axes[axis], step)))
 
         def rotate(axis, step):
-            #self.prosthesis_transform.Identity()
-            if axis == 'x':
-                self.prosthesis_transform.RotateWXYZ(step, 1, 0, 0)
-            elif axis == 'y':
-                self.prosthesis_transform.RotateWXYZ(step, 0, 1, 0)
-            elif axis == 'z':
-                self.prosthesis_transform.RotateWXYZ(step, 0, 0, 1)
-            widget.GetRenderWindow().Render()
+            self.set_implant_pose(self.implant_pose.rotated(axes[axis], step))
 
         # Translation Buttons
         translation_buttons = [
@@ -603,6 +1826,8 @@ class HipReplacementApp(QMainWindow):
         measurement_layout = QVBoxLayout()
         measurement_layout.addWidget(self.angle_button)
         measurement_layout.addWidget(self.distance_button)
+        measurement_layout.addWidget(self.distance_3d_button)
+        measurement_layout.addWidget(self.angle_3d_button)
         measurement_group.setLayout(measurement_layout)
         button_column_layout.addWidget(measurement_group)
 
@@ -612,6 +1837,10 @@ class HipReplacementApp(QMainWindow):
         rendering_layout.addWidget(self.toggle_button_opacity)
         rendering_layout.addWidget(self.scale_up_button)
         rendering_layout.addWidget(self.scale_down_button)
+        rendering_layout.addWidget(self.undo_pose_button)
+        rendering_layout.addWidget(self.redo_pose_button)
+        rendering_layout.addWidget(self.export_plan_button)
+        rendering_layout.addWidget(self.compare_plans_button)
         rendering_group.setLayout(rendering_layout)
         button_column_layout.addWidget(rendering_group)
 
@@ -702,6 +1931,7 @@ class HipReplacementApp(QMainWindow):
             camera.SetViewUp(*new_view_up)
 
             self.renderer.ResetCameraClippingRange()
+            self.quality.interaction(frame_time=interval / 1000)
             self.renderer.GetRenderWindow().Render()
 
             if step < steps:
@@ -724,9 +1954,7 @@ class HipReplacementApp(QMainWindow):
                 self.distance_button.setText("Distance Mode: ON")
             else:
                 if visualizer.distance_widget and visualizer.distance_widget.GetEnabled():
-                    visualizer.distance_widget.Off()
-                    if hasattr(visualizer, 'distance_text_actor'):
-                        visualizer.widget.GetRenderWindow().Render() 
+                    visualizer.toggle_distance_measurement()  # the measurement stays in the annotation store
                 self.distance_button.setStyleSheet("")  
                 self.distance_button.setText("Distance Measurement Mode")
 
@@ -741,9 +1969,7 @@ class HipReplacementApp(QMainWindow):
                 self.angle_button.setText("Angle Mode: ON")
             else:
                 if visualizer.angle_widget and visualizer.angle_widget.GetEnabled():
-                    visualizer.angle_widget.Off()  # Correctly deactivate the angle widget
-                    if hasattr(visualizer, 'angle_text_actor'):
-                        visualizer.widget.GetRenderWindow().Render()
+                    visualizer.toggle_angle_measurement()  # Correctly deactivate the angle widget
                 self.angle_button.setStyleSheet("")  # Default style (inactive)
                 self.angle_button.setText("Angle Measurement Mode")
 
@@ -752,7 +1978,7 @@ class HipReplacementApp(QMainWindow):
     
     def init_3d_view(self):
         # widget
-        widget = QVTKRenderWindowInteractor(self.frame)
+        widget = create_render_widget(self.frame, self.offscreen)
         widget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
 
         # renderer
@@ -772,6 +1998,7 @@ class HipReplacementApp(QMainWindow):
 
         # PROSTHESIS MODEL RENDERING (surface)
         self.prosthesis_rendering()
+        self.memory.measure("implant")
 
         # Add a reference axis to the scene
         axes = vtk.vtkAxesActor()
@@ -787,6 +2014,10 @@ class HipReplacementApp(QMainWindow):
         self.renderer.AddActor(axes)
         self.renderer.SetBackground(0.1, 0.1, 0.1)
         self.renderer.GetRenderWindow().Render()
+        self.memory.measure("3D volume")  # the volume is uploaded on the first render
+
+        # lower quality while interacting / animating
+        self.quality = AdaptiveQualityController(self.renderer, self.volume, widget.GetRenderWindow().GetInteractor())
 
         # Setup additional features
         self.plane_widget_setup(widget)
@@ -795,17 +2026,124 @@ class HipReplacementApp(QMainWindow):
         self.undo_button_setup(widget)
 
         self.mpr_slice_updates()
+        self.surface_measurement_setup(widget)
 
         # Setup Prosthesis Manipulation Buttons
         translation_buttons, rotation_buttons = self.prosthesis_buttons(widget)
         self.opacity_toggle_button(widget, self.volume.GetProperty())
         self.scaling_prosthesis_button(widget)
+        self.pose_history_buttons(widget)
+        self.export_plan_setup()
+        self.compare_plans_setup()
 
         # Add widgets to the layout
         self.add_buttons_to_layout(widget, translation_buttons, rotation_buttons)
 
 
+    def session_state(self): # implant pose, cut, camera and slice positions, as plain JSON-able values
+        camera = self.renderer.GetActiveCamera()
+        return {
+            "prosthesis": os.path.abspath(self.prosthesis_path),  # the pose (and its scale) is only valid for this implant
+            "side": self.side,
+            "pose": self.implant_pose.as_array().tolist(),
+            "cut": {
+                "origin": list(self.cutting_plane.GetOrigin()),
+                "normal": list(self.cutting_plane.GetNormal()),
+            } if self.cut_active else None,
+            "camera": {
+                "position": list(camera.GetPosition()),
+                "focal_point": list(camera.GetFocalPoint()),
+                "view_up": list(camera.GetViewUp()),
+                "view_angle": camera.GetViewAngle(),
+                "parallel_scale": camera.GetParallelScale(),
+            },
+            "slices": {plane: list(visualizer.reslice.GetResliceAxesOrigin()) for plane, visualizer in self.mpr_views.items()},
+        }
+
+
+    def apply_session_state(self, state, render=True): # the final state is applied directly, the moves themselves are not replayed
+        # implant pose (None: keep the current one)
+        if state["pose"] is not None:
+            self.implant_pose = ImplantPose.from_array(state["pose"])
+            self.prosthesis_actor.SetUserMatrix(self.implant_pose.matrix())
+
+        # cut
+        if state["cut"]:
+            if not self.cut_active or list(self.cutting_plane.GetOrigin()) != state["cut"]["origin"] or list(self.cutting_plane.GetNormal()) != state["cut"]["normal"]:
+                self.plane_widget.SetOrigin(*state["cut"]["origin"])
+                self.plane_widget.SetNormal(*state["cut"]["normal"])
+                self.cut_button.click()
+        elif self.cut_active:
+            self.undo_button.click()
+
+        # camera
+        camera = self.renderer.GetActiveCamera()
+        camera.SetPosition(*state["camera"]["position"])
+        camera.SetFocalPoint(*state["camera"]["focal_point"])
+        camera.SetViewUp(*state["camera"]["view_up"])
+        camera.SetViewAngle(state["camera"]["view_angle"])
+        camera.SetParallelScale(state["camera"]["parallel_scale"])
+        self.renderer.ResetCameraClippingRange()
+        if render:
+            self.renderer.GetRenderWindow().Render()
+
+        # slices (the sliders follow without re-slicing twice)
+        for plane, origin in state["slices"].items():
+            visualizer = self.mpr_views[plane]
+            slicing_axis = {"axial": 2, "coronal": 1, "sagittal": 0}[plane]
+            index = round((origin[slicing_axis] - self.image_data.GetOrigin()[slicing_axis]) / self.image_data.GetSpacing()[slicing_axis])
+            self.sliders[plane].blockSignals(True)
+            self.sliders[plane].setValue(index + 1)
+            self.sliders[plane].blockSignals(False)
+            if list(visualizer.reslice.GetResliceAxesOrigin()) != origin:
+                visualizer.reslice.SetResliceAxesOrigin(*origin)
+                visualizer.reslice.Update()
+            if render:
+                visualizer.widget.GetRenderWindow().Render()
+
+
+    def save_session(self):
+        path = session_path(self.image_path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as session_file:
+                json.dump(self.session_state(), session_file, indent=2)
+        except OSError as error:  # read-only / network case folder: the app must still close
+            print(f"Could not save the session {path}: {error}")
+
+
+    def restore_session(self):
+        path = session_path(self.image_path)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as session_file:
+                session = json.load(session_file)
+        except (OSError, ValueError) as error:
+            print(f"Could not read the session {path}: {error}")
+            return
+
+        # another implant or side: the pose does not apply, the implant starts at the default pose of this side
+        if session.get("prosthesis") != os.path.abspath(self.prosthesis_path) or session.get("side") != self.side:
+            print("The session was saved with another implant or side: the implant pose is not restored.")
+            session["pose"] = None
+
+        self.apply_session_state(session)
+        if session["pose"] is not None:
+            self.pose_history = PoseHistory(self.implant_pose)  # the history starts again from the restored pose
+
+
     def closeEvent(self, event):
+        # Keep the plan where the surgeon left it
+        self.save_session()
+
+        # Keep the measurements of this case (a read-only case folder must not stop the app from closing)
+        if len(self.annotations) or os.path.exists(annotation_path(self.image_path)):
+            try:
+                self.annotations.save(annotation_path(self.image_path))
+            except OSError as error:
+                print(f"Could not save the annotations {annotation_path(self.image_path)}: {error}")
+
         # Proper cleanup for all MPR views
         for plane, visualizer in self.mpr_views.items():  # Access MPRVisualizer directly
             widget = visualizer.widget  # Access widget from visualizer
@@ -851,19 +2189,341 @@ class HipReplacementApp(QMainWindow):
 
 
 
+# PLAN COMPARISON: N plans (implant sizes, left / right) side by side, one 3D viewport per plan.
+# all the viewports are in one render window (one GL context, the volume is uploaded once) and share the decoded CT,
+# the cropped mask volume, the camera and the slices of the main window; a plan only adds its implant actor
+# (and its mesh, read once per implant file)
+
+COMPARISON_SLICE_HEIGHT = 0.3  # part of the window under the 3D viewports, for the slices
+
+class PlanComparisonWindow(QMainWindow):
+    def __init__(self, app_window, plans, offscreen=False): # plans: [(name, implant mesh, pose)]
+        super().__init__()
+        self.app_window = app_window
+        self.plan_names = [name for name, mesh, pose in plans]
+        self.poses = [pose for name, mesh, pose in plans]
+
+        self.setWindowTitle(f"Plan Comparison ({len(plans)} plans)")
+        self.setGeometry(150, 150, 600 * len(plans), 1000)
+
+        self.central_widget = QWidget(self)
+        self.setCentralWidget(self.central_widget)
+        self.layout = QGridLayout(self.central_widget)
+
+        self.widget = create_render_widget(self.central_widget, offscreen)
+        self.widget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.render_window = self.widget.GetRenderWindow()
+        self.layout.addWidget(self.widget, 0, 0)
+
+        # the cut of the main view when the comparison is opened (the plans are compared on the same cut bone)
+        self.cutting_plane = None
+        if app_window.cut_active:
+            self.cutting_plane = vtk.vtkPlane()
+            self.cutting_plane.SetOrigin(app_window.cutting_plane.GetOrigin())
+            self.cutting_plane.SetNormal(app_window.cutting_plane.GetNormal())
+
+        # one volume for all the plans: the mask cropped to the bones, with the transfer functions of the main 3D view.
+        # the property itself is a copy sharing them, so the lower quality of the main view while it moves does not apply
+        volume_mapper = vtk.vtkGPUVolumeRayCastMapper()
+        volume_mapper.SetInputData(app_window.cropped_mask())
+        if self.cutting_plane is not None:
+            volume_mapper.AddClippingPlane(self.cutting_plane)
+        volume_property = vtk.vtkVolumeProperty()
+        volume_property.DeepCopy(app_window.volume.GetProperty())
+        volume_property.SetColor(app_window.volume.GetProperty().GetRGBTransferFunction())
+        volume_property.SetScalarOpacity(app_window.volume.GetProperty().GetScalarOpacity())
+        volume_property.SetShade(app_window.quality.full_quality[3])
+        self.volume = vtk.vtkVolume()
+        self.volume.SetMapper(volume_mapper)
+        self.volume.SetProperty(volume_property)
+
+        # one camera: every plan is seen from the same viewpoint, starting from the one of the main 3D view
+        self.camera = vtk.vtkCamera()
+        self.camera.DeepCopy(app_window.renderer.GetActiveCamera())
+
+        self.renderers = []
+        self.plan_actors = []
+        mappers = {}  # one mapper per implant mesh
+        for i, (name, mesh, pose) in enumerate(plans):
+            if id(mesh) not in mappers:
+                mappers[id(mesh)] = vtk.vtkPolyDataMapper()
+                mappers[id(mesh)].SetInputData(mesh)
+                if self.cutting_plane is not None:
+                    mappers[id(mesh)].AddClippingPlane(self.cutting_plane)
+
+            actor = vtk.vtkActor()
+            actor.SetMapper(mappers[id(mesh)])
+            actor.GetProperty().SetColor(1.0, 0.5, 0.0)  # Orange, as in the main view
+            actor.SetUserMatrix(pose.matrix())
+
+            label = vtk.vtkTextActor()
+            label.SetInput(name)
+            label.GetTextProperty().SetFontSize(18)
+            label.SetPosition(10, 10)
+
+            renderer = vtk.vtkRenderer()
+            renderer.SetViewport(i / len(plans), COMPARISON_SLICE_HEIGHT, (i + 1) / len(plans), 1)
+            renderer.SetActiveCamera(self.camera)
+            renderer.AddVolume(self.volume)
+            renderer.AddActor(actor)
+            renderer.AddViewProp(label)
+            renderer.SetBackground(0.1, 0.1, 0.1)
+            self.render_window.AddRenderer(renderer)
+            self.renderers.append(renderer)
+            self.plan_actors.append(actor)
+
+        # slices of the main window: their reslice / window-level outputs are displayed again, not recomputed
+        for i, visualizer in enumerate(app_window.mpr_views.values()):
+            image_actor = vtk.vtkImageActor()
+            image_actor.GetMapper().SetInputConnection(visualizer.window_level.GetOutputPort())
+            renderer = vtk.vtkRenderer()
+            renderer.SetViewport(i / 3, 0, (i + 1) / 3, COMPARISON_SLICE_HEIGHT)
+            renderer.AddActor(image_actor)
+            renderer.SetBackground(0.0, 0.0, 0.0)
+            renderer.InteractiveOff()  # the camera interaction is for the 3D viewports
+            renderer.ResetCamera()
+            self.render_window.AddRenderer(renderer)
+        for slider in app_window.sliders.values():
+            slider.valueChanged.connect(self.render)
+
+        self.render_window.GetInteractor().SetInteractorStyle(vtk.vtkInteractorStyleTrackballCamera())
+        self.render_window.AddObserver("StartEvent", self.reset_clipping_range)
+
+        self.pose_controls()
+        self.render()
+        app_window.memory.measure(f"comparison ({len(plans)} plans)")
+        app_window.memory.report()
+
+    def pose_controls(self): # the selected plan is moved with the same steps as the main prosthesis buttons
+        self.plan_selector = QComboBox(self.central_widget)
+        self.plan_selector.addItems(self.plan_names)
+
+        controls = QHBoxLayout()
+        controls.addWidget(self.plan_selector)
+        axes = {'x': (1, 0, 0), 'y': (0, 1, 0), 'z': (0, 0, 1)}
+        for axis in axes:
+            for sign, label in ((1, "+"), (-1, "-")):
+                translate = QPushButton(f"Translate {label}{axis.upper()}", self.central_widget)
+                translate.clicked.connect(lambda checked, axis=axis, sign=sign: self.move_plan(
+                    lambda pose: pose.translated(np.multiply(axes[axis], 5 * sign))))
+                rotate = QPushButton(f"Rotate {label}{axis.upper()}", self.central_widget)
+                rotate.clicked.connect(lambda checked, axis=axis, sign=sign: self.move_plan(
+                    lambda pose: pose.rotated(axes[axis], 5 * sign)))
+                controls.addWidget(translate)
+                controls.addWidget(rotate)
+        self.layout.addLayout(controls, 1, 0)
+
+    def move_plan(self, move): # move: pose -> new pose, applied to the selected plan
+        index = self.plan_selector.currentIndex()
+        self.poses[index] = move(self.poses[index])
+        self.plan_actors[index].SetUserMatrix(self.poses[index].matrix())
+        self.render()
+
+    def reset_clipping_range(self, obj=None, event=None): # the camera is shared: clipping range from all the plans
+        bounds = np.array([renderer.ComputeVisiblePropBounds() for renderer in self.renderers])
+        self.renderers[0].ResetCameraClippingRange(
+            *[bounds[:, i].min() if i % 2 == 0 else bounds[:, i].max() for i in range(6)]
+        )
+
+    def render(self):
+        self.render_window.Render()
+
+    def closeEvent(self, event):
+        for slider in self.app_window.sliders.values():
+            slider.valueChanged.disconnect(self.render)
+        interactor = self.render_window.GetInteractor()
+        if interactor:
+            interactor.Disable()
+        self.render_window.Finalize()
+        event.accept()
+
+
+
+
+# RENDER SERVER
+# one offscreen HipReplacementApp on a strong workstation streams JPEG frames of the 4 views over a local WebSocket.
+# every client keeps its own pose / camera / slices: they are applied to the shared pipeline just before its frames
+# are rendered, and a view is only rendered and encoded again when the part of the state it depends on changed
+
+SERVER_PORT = 8765
+AXES = {"x": (1, 0, 0), "y": (0, 1, 0), "z": (0, 0, 1)}
+
+
+class RenderServer:
+    def __init__(self, app_window, jpeg_quality=80):
+        self.window = app_window
+        self.initial_state = app_window.session_state()  # where every new client starts
+        self.render_windows = {plane: visualizer.widget.GetRenderWindow() for plane, visualizer in app_window.mpr_views.items()}
+        self.render_windows["3d"] = app_window.renderer.GetRenderWindow()
+
+        # one grabber + encoder per view, reused for every frame
+        self.encoders = {}
+        for view, render_window in self.render_windows.items():
+            grabber = vtk.vtkWindowToImageFilter()
+            grabber.SetInput(render_window)
+            grabber.ReadFrontBufferOff()
+            grabber.ShouldRerenderOff()  # the view is rendered just before the grab
+            encoder = vtk.vtkJPEGWriter()
+            encoder.SetInputConnection(grabber.GetOutputPort())
+            encoder.SetQuality(jpeg_quality)
+            encoder.WriteToMemoryOn()
+            self.encoders[view] = (grabber, encoder)
+
+    def info(self): # sent once to a new client so it can build its controls
+        dimensions = self.window.image_data.GetDimensions()
+        return {
+            "type": "info",
+            "views": list(self.render_windows),
+            "slices": {plane: dimensions[{"axial": 2, "coronal": 1, "sagittal": 0}[plane]] for plane in self.window.mpr_views},
+        }
+
+    @staticmethod
+    def view_key(state, view): # the part of a client state a view depends on
+        if view == "3d":
+            return json.dumps([state["pose"], state["cut"], state["camera"]])
+        return json.dumps(state["slices"][view])
+
+    def apply_command(self, state, command): # new client state after a slice / pose / camera command
+        state = json.loads(json.dumps(state))
+        kind = command["type"]
+
+        if kind == "slice": # {"type": "slice", "view": "axial", "index": 40}
+            visualizer = self.window.mpr_views[command["view"]]
+            slicing_axis = {"axial": 2, "coronal": 1, "sagittal": 0}[command["view"]]
+            last = visualizer.image_data.GetDimensions()[slicing_axis] - 1
+            state["slices"][command["view"]][slicing_axis] = visualizer.slice_position(min(max(int(command["index"]), 0), last))
+
+        elif kind == "pose": # {"type": "pose", "translate": [0, 0, 5]} / "rotate": {"axis": "x", "angle": 5} / "scale": 1.1 / "pose": [8 numbers]
+            pose = ImplantPose.from_array(command["pose"]) if "pose" in command else ImplantPose.from_array(state["pose"])
+            if "translate" in command:
+                pose = pose.translated(command["translate"])
+            if "rotate" in command:
+                axis = command["rotate"]["axis"]
+                pose = pose.rotated(AXES.get(axis, axis), command["rotate"]["angle"])
+            if "scale" in command:
+                pose = pose.scaled(command["scale"])
+            state["pose"] = pose.as_array().tolist()
+
+        elif kind == "camera": # {"type": "camera", "azimuth": 10, "elevation": 0, "zoom": 1.2} and / or position, focal_point, view_up
+            camera = vtk.vtkCamera()
+            camera.SetPosition(*command.get("position", state["camera"]["position"]))
+            camera.SetFocalPoint(*command.get("focal_point", state["camera"]["focal_point"]))
+            camera.SetViewUp(*command.get("view_up", state["camera"]["view_up"]))
+            camera.SetViewAngle(state["camera"]["view_angle"])
+            camera.SetParallelScale(state["camera"]["parallel_scale"])
+            camera.Azimuth(command.get("azimuth", 0))
+            camera.Elevation(command.get("elevation", 0))
+            camera.Zoom(command.get("zoom", 1))
+            camera.OrthogonalizeViewUp()
+            state["camera"].update(
+                position=list(camera.GetPosition()), focal_point=list(camera.GetFocalPoint()),
+                view_up=list(camera.GetViewUp()), view_angle=camera.GetViewAngle(), parallel_scale=camera.GetParallelScale(),
+            )
+
+        else:
+            raise ValueError(f"unknown command type {kind!r}")
+        return state
+
+    def render_changed(self, state, sent_keys): # [(view, jpeg bytes)] for the views whose state changed since the last frame
+        changed = [view for view in self.render_windows if sent_keys.get(view) != self.view_key(state, view)]
+        if not changed:
+            return []
+        self.window.apply_session_state(state, render=False)
+        frames = []
+        for view in changed:
+            self.render_windows[view].Render()
+            grabber, encoder = self.encoders[view]
+            grabber.Modified()
+            encoder.Write()
+            frames.append((view, numpy_support.vtk_to_numpy(encoder.GetResult()).tobytes()))
+            sent_keys[view] = self.view_key(state, view)
+        return frames
+
+    async def send_frames(self, connection, state, sent_keys):
+        # each frame is a JSON header followed by the JPEG as a binary message
+        for view, frame in self.render_changed(state, sent_keys):
+            await connection.send(json.dumps({"type": "frame", "view": view, "format": "jpeg", "size": len(frame)}))
+            await connection.send(frame)
+
+    async def handle_client(self, connection, path=None):
+        state = json.loads(json.dumps(self.initial_state))
+        sent_keys = {}
+        await connection.send(json.dumps(self.info()))
+        await self.send_frames(connection, state, sent_keys)
+
+        async for message in connection:
+            try:
+                state = self.apply_command(state, json.loads(message))
+            except (ValueError, KeyError, TypeError, IndexError) as error:
+                await connection.send(json.dumps({"type": "error", "message": f"{type(error).__name__}: {error}"}))
+                continue
+            await self.send_frames(connection, state, sent_keys)
+
+    def serve(self, host="127.0.0.1", port=SERVER_PORT):
+        try:
+            import websockets
+        except ImportError:
+            sys.exit("The render server needs the websockets package: pip install websockets")
+
+        async def main():
+            async with websockets.serve(self.handle_client, host, port):
+                print(f"Render server listening on ws://{host}:{port}")
+                await asyncio.Future()  # until interrupted
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            print("Render server stopped.")
+
+
+def serve_main(argv): # python Group12.py --serve image.nii.gz prosthesis.stl Right [--mask mask.nii.gz] [--port 8765]
+    parser = argparse.ArgumentParser(prog="Group12.py --serve", description="Stream the planning views to lightweight clients.")
+    parser.add_argument("image")
+    parser.add_argument("prosthesis")
+    parser.add_argument("side", choices=["Right", "Left"])
+    parser.add_argument("--mask", help="bone mask (generated from the CT when omitted)")
+    parser.add_argument("--host", default="127.0.0.1", help="0.0.0.0 to accept the other machines of the local network")
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--quality", type=int, default=80, help="JPEG quality of the frames")
+    parser.add_argument("--memory-budget", type=float, default=MEMORY_BUDGET_MB)
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")  # no display needed on the server
+    app = QApplication(sys.argv[:1])
+    window = HipReplacementApp(args.image, args.mask, args.prosthesis, args.side, args.memory_budget, offscreen=True)
+    RenderServer(window, args.quality).serve(args.host, args.port)
+
+
+
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    # Render server, no window: python Group12.py --serve image.nii.gz prosthesis.stl Right (see serve_main)
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        serve_main(sys.argv[2:])
+        sys.exit(0)
+
+    # Bulk export, no GUI: python Group12.py --export-annotations out.csv case1.nii.gz case2.nii.gz ... (see export_annotations_main)
+    if len(sys.argv) > 1 and sys.argv[1] == "--export-annotations":
+        export_annotations_main(sys.argv[2:])
+        sys.exit(0)
+
+    # Memory budget: python Group12.py --memory-budget 6000 (the other arguments are left to Qt)
+    parser = argparse.ArgumentParser(prog="Group12.py", description="Plan a hip replacement on a CT scan.")
+    parser.add_argument("--memory-budget", type=float, default=MEMORY_BUDGET_MB,
+                        help="MB; above it the 3D volume and the slice previews are downsampled")
+    args, qt_args = parser.parse_known_args()
+
+    app = QApplication(sys.argv[:1] + qt_args)
 
     # Call the function to get image, mask, prosthesis files, and side
     image_path, mask_path, prosthesis_path, side = choose_files()
 
     # Ensure all input files exist
-    if not os.path.exists(image_path) or not os.path.exists(mask_path) or not os.path.exists(prosthesis_path):
+    if not os.path.exists(image_path) or (mask_path and not os.path.exists(mask_path)) or not os.path.exists(prosthesis_path):
         print("Error: Ensure all input files are present and valid.")
         sys.exit(1)
 
     # Initialize the application with the chosen parameters
-    main_window = HipReplacementApp(image_path, mask_path, prosthesis_path, side)
+    main_window = HipReplacementApp(image_path, mask_path, prosthesis_path, side, args.memory_budget)
     main_window.visualize()
     sys.exit(app.exec_())
 
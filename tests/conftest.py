@@ -0,0 +1,7 @@
+import os
+
+# headless runs (CI, servers): Qt without a display, VTK rendering offscreen through EGL
+if not os.environ.get("DISPLAY"):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+    os.environ.setdefault("VTK_DEFAULT_OPENGL_WINDOW", "vtkEGLRenderWindow")
@@ -0,0 +1,91 @@
+import os
+import sys
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+import pytest
+import vtk
+from PyQt5.QtWidgets import QApplication
+
+import Group12
+
+
+class TimedRenderer: # stands in for the vtkRenderer: every render takes render_time seconds
+    def __init__(self, render_time):
+        self.render_time = render_time
+
+    def GetLastRenderTimeInSeconds(self):
+        return self.render_time
+
+    def GetRenderWindow(self):
+        return self
+
+    def Render(self):
+        pass
+
+
+@pytest.fixture
+def controller():
+    app = QApplication.instance() or QApplication([])  # the idle timer needs a Qt application
+    image = vtk.vtkImageData()
+    image.SetDimensions(8, 8, 8)
+    image.SetSpacing(0.5, 0.5, 1.0)
+    image.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    mapper = vtk.vtkGPUVolumeRayCastMapper()
+    mapper.SetInputData(image)
+    volume = vtk.vtkVolume()
+    volume.SetMapper(mapper)
+    volume.GetProperty().ShadeOn()
+
+    interactor = vtk.vtkGenericRenderWindowInteractor()
+    interactor.SetDesiredUpdateRate(15)
+    controller = Group12.AdaptiveQualityController(vtk.vtkRenderer(), volume, interactor)
+    yield controller
+    controller.idle_timer.stop()
+
+
+def drag(controller, render_time, events=30): # mouse drag: one render after every event
+    controller.renderer = TimedRenderer(render_time)
+    for _ in range(3):  # full quality renders before the drag
+        controller.on_render_end(None, "EndEvent")
+    for _ in range(events):
+        controller.interaction()
+        controller.on_render_end(None, "EndEvent")
+
+
+def test_slow_renders_lower_quality(controller):
+    drag(controller, render_time=0.1)
+
+    assert controller.interactive
+    assert controller.level > 1
+    assert controller.mapper.GetSampleDistance() > controller.base_sample_distance
+    assert not controller.volume_property.GetShade()
+
+
+def test_fast_renders_keep_full_quality(controller):
+    drag(controller, render_time=0.01)
+
+    assert not controller.interactive
+    assert controller.level == 1
+    assert controller.volume_property.GetShade()
+
+
+def test_idle_restores_full_quality(controller):
+    drag(controller, render_time=0.1)
+    controller.restore_full_quality()
+
+    assert not controller.interactive
+    assert controller.volume_property.GetShade()
+    assert controller.mapper.GetImageSampleDistance() == controller.full_quality[2]
+    assert np.isclose(controller.mapper.GetSampleDistance(), controller.full_quality[1])
+
+
+def test_animation_pace_is_the_target(controller):
+    controller.renderer = TimedRenderer(0.1)
+    controller.on_render_end(None, "EndEvent")
+    controller.interaction(frame_time=0.5)
+
+    assert controller.target_frame_time == 0.5
+    assert not controller.interactive
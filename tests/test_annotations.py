@@ -0,0 +1,81 @@
+import csv
+import os
+import sys
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+
+import Group12
+
+
+def test_add_update_and_grow():
+    store = Group12.AnnotationStore(capacity=2)
+    for i in range(5):
+        assert store.add("distance", "axial", i, [(i, 0, 0), (i, 1, 0)]) == i
+    store.update(1, "angle", "3d", 90.0, [(0, 0, 0), (1, 0, 0), (1, 1, 0)])
+
+    assert len(store) == 5
+    assert len(store.kinds) >= 5
+    assert store.get(4)["value"] == 4
+    assert np.array_equal(store.get(4)["points"], [(4, 0, 0), (4, 1, 0)])
+    updated = store.get(1)
+    assert (updated["kind"], updated["view"], updated["value"]) == ("angle", "3d", 90.0)
+    assert len(updated["points"]) == 3
+    assert store.describe(0) == "#1 distance (axial): 0.00 mm"
+
+
+def test_hit_test_nearest_first():
+    store = Group12.AnnotationStore()
+    store.add("distance", "axial", 1.0, [(0, 0, 0), (10, 0, 0)])
+    store.add("distance", "axial", 1.0, [(2, 0, 0), (50, 0, 0)])
+    store.add("distance", "axial", 1.0, [(100, 0, 0), (110, 0, 0)])
+
+    assert store.hit_test((1.5, 0, 0), 5) == [1, 0]
+    assert store.hit_test((9, 0, 0), 5) == [0]
+    assert store.hit_test((70, 0, 0), 5) == []
+
+    # the locator follows the changes
+    store.update(2, "distance", "axial", 1.0, [(1.6, 0, 0), (110, 0, 0)])
+    assert store.hit_test((1.5, 0, 0), 5) == [2, 1, 0]
+
+
+def test_save_load_round_trip(tmp_path):
+    store = Group12.AnnotationStore()
+    store.add("distance", "coronal", 12.5, [(1, 2, 3), (4, 5, 6)])
+    store.add("angle", "3d", 45.0, [(0, 0, 0), (1, 0, 0), (1, 1, 0)])
+    path = str(tmp_path / ".annotations" / "case.npz")
+    store.save(path)
+
+    loaded = Group12.AnnotationStore.load(path)
+    assert len(loaded) == 2
+    for index in range(2):
+        original, again = store.get(index), loaded.get(index)
+        assert (again["kind"], again["view"], again["value"]) == (original["kind"], original["view"], original["value"])
+        assert np.array_equal(again["points"], original["points"])
+    assert loaded.add("distance", "axial", 1.0, [(0, 0, 0), (1, 0, 0)]) == 2
+    assert len(Group12.AnnotationStore.load(str(tmp_path / "missing.npz"))) == 0
+
+
+def test_export_annotations(tmp_path):
+    image_paths = [str(tmp_path / "case1.nii.gz"), str(tmp_path / "case2.nii.gz"), str(tmp_path / "case3.nii.gz")]
+    first = Group12.AnnotationStore()
+    first.add("distance", "axial", 10.0, [(0, 0, 0), (10, 0, 0)])
+    first.add("angle", "sagittal", 30.0, [(0, 0, 0), (1, 0, 0), (1, 1, 0)])
+    first.save(Group12.annotation_path(image_paths[0]))
+    second = Group12.AnnotationStore()
+    second.add("distance", "3d", 5.0, [(1, 1, 1), (1, 1, 6)])
+    second.save(Group12.annotation_path(image_paths[1]))  # case3 has no annotations
+
+    csv_path = str(tmp_path / "out.csv")
+    Group12.export_annotations(image_paths, csv_path)
+    with open(csv_path, newline="") as csv_file:
+        rows = list(csv.DictReader(csv_file))
+
+    assert [(row["case"], row["index"], row["kind"], row["view"]) for row in rows] == [
+        ("case1", "1", "distance", "axial"), ("case1", "2", "angle", "sagittal"), ("case2", "1", "distance", "3d"),
+    ]
+    assert float(rows[2]["value"]) == 5.0
+    assert float(rows[2]["p2_z"]) == 6.0
+    assert rows[0]["p3_x"] == "nan"
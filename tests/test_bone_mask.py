@@ -0,0 +1,103 @@
+import os
+import sys
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+import vtk
+
+import Group12
+
+
+def tube(shape=(20, 20, 20), outer=6, inner=3): # bone shaft along z with a marrow canal, open at both ends
+    z, y, x = np.indices(shape)
+    radius = np.hypot(y - shape[1] / 2, x - shape[2] / 2)
+    return radius <= outer, radius <= inner
+
+
+def test_fill_holes_enclosed_cavity():
+    cavity = np.zeros((16, 16, 16), dtype=bool)
+    cavity[4:12, 4:12, 4:12] = True
+    shell = np.zeros_like(cavity)
+    shell[2:14, 2:14, 2:14] = True
+    shell &= ~cavity
+
+    filled = Group12.fill_holes(shell, (1, 1, 1), (0, 0, 0))
+
+    assert filled[cavity].all()
+    assert not filled[0].any()
+
+
+def test_fill_holes_canal_open_along_z():
+    shaft, canal = tube()
+    bone = shaft & ~canal
+
+    filled = Group12.fill_holes(bone, (1, 1, 1), (0, 0, 0))
+
+    assert np.array_equal(filled, shaft)
+
+
+def test_generate_bone_mask_fills_marrow(tmp_path):
+    shaft, canal = tube((30, 40, 40))
+    ct = np.full(shaft.shape, -1000, dtype=np.int16)
+    ct[shaft] = 1200  # cortical bone
+    ct[canal] = 40  # marrow, below the bone threshold
+
+    image_path = str(tmp_path / "ct.nii.gz")
+    writer = vtk.vtkNIFTIImageWriter()
+    writer.SetInputData(Group12.array_to_image(ct, (1, 1, 1), (0, 0, 0)))
+    writer.SetFileName(image_path)
+    writer.Write()
+    reader = vtk.vtkNIFTIImageReader()
+    reader.SetFileName(image_path)
+    reader.Update()
+
+    mask_path = Group12.generate_bone_mask(reader, image_path, min_voxels=10)
+    mask_reader = vtk.vtkNIFTIImageReader()
+    mask_reader.SetFileName(mask_path)
+    mask_reader.Update()
+    mask = Group12.image_to_array(mask_reader.GetOutput())
+
+    assert np.array_equal(mask > 0, shaft)
+
+
+def write_ct(directory, shape=(30, 40, 40)):
+    shaft, canal = tube(shape)
+    ct = np.full(shaft.shape, -1000, dtype=np.int16)
+    ct[shaft] = 1200
+    image_path = str(directory / "ct.nii.gz")
+    writer = vtk.vtkNIFTIImageWriter()
+    writer.SetInputData(Group12.array_to_image(ct, (1, 1, 1), (0, 0, 0)))
+    writer.SetFileName(image_path)
+    writer.Write()
+    reader = vtk.vtkNIFTIImageReader()
+    reader.SetFileName(image_path)
+    reader.Update()
+    return image_path, reader
+
+
+def test_cache_depends_on_min_voxels(tmp_path):
+    image_path, reader = write_ct(tmp_path)
+
+    small = Group12.generate_bone_mask(reader, image_path, min_voxels=10)
+    large = Group12.generate_bone_mask(reader, image_path, min_voxels=10**9)
+    mask_reader = vtk.vtkNIFTIImageReader()
+    mask_reader.SetFileName(large)
+    mask_reader.Update()
+
+    assert small != large
+    assert not Group12.image_to_array(mask_reader.GetOutput()).any()  # every component is below min_voxels
+    assert Group12.generate_bone_mask(reader, image_path, min_voxels=10) == small
+
+
+def test_cache_falls_back_to_the_user_cache(tmp_path, monkeypatch):
+    image_path, reader = write_ct(tmp_path)
+    (tmp_path / Group12.MASK_CACHE_DIR).write_text("")  # the cache directory cannot be created next to the CT
+    monkeypatch.setattr(Group12, "USER_MASK_CACHE_DIR", str(tmp_path / "user_cache"))
+
+    mask_path = Group12.generate_bone_mask(reader, image_path, min_voxels=10)
+
+    assert mask_path.startswith(str(tmp_path / "user_cache"))
+    assert os.path.exists(mask_path)
+    assert Group12.generate_bone_mask(reader, image_path, min_voxels=10) == mask_path
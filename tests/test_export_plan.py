@@ -0,0 +1,53 @@
+import os
+import sys
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+import vtk
+
+import Group12
+
+
+def read_hu(path): # values of a NIfTI file in HU (raw values through scl_slope / scl_inter)
+    reader = vtk.vtkNIFTIImageReader()
+    reader.SetFileName(path)
+    reader.Update()
+    raw = Group12.image_to_array(reader.GetOutput()).astype(float)
+    return raw * (reader.GetRescaleSlope() or 1.0) + reader.GetRescaleIntercept(), reader
+
+
+def test_export_plan_keeps_hu(tmp_path):
+    # uint16 CT stored with an intercept of -1024: raw 0 is air
+    ct = np.zeros((20, 20, 20), dtype=np.uint16)
+    ct[:, :, :10] = 1024 + 40  # soft tissue on one side
+    image_path = str(tmp_path / "ct.nii.gz")
+    writer = vtk.vtkNIFTIImageWriter()
+    writer.SetInputData(Group12.array_to_image(ct, (1, 1, 1), (0, 0, 0)))
+    writer.SetRescaleIntercept(-1024)
+    writer.SetRescaleSlope(1)
+    writer.SetFileName(image_path)
+    writer.Write()
+    reader = vtk.vtkNIFTIImageReader()
+    reader.SetFileName(image_path)
+    reader.Update()
+
+    # implant: closed cube in the air side of the CT
+    cube = vtk.vtkCubeSource()
+    cube.SetBounds(12, 17, 5, 15, 5, 15)
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(cube.GetOutputPort())
+    triangles.Update()
+    matrix = vtk.vtkMatrix4x4()
+
+    mask_path, fused_path = Group12.export_plan(triangles.GetOutput(), matrix, reader, image_path)
+    implant, _ = read_hu(mask_path)
+    fused, _ = read_hu(fused_path)
+    inside = implant > 0
+
+    assert inside.sum() > 0
+    assert np.all(fused[inside] == Group12.IMPLANT_HU)
+    assert fused[0, 0, 19] == -1024  # air
+    assert fused[0, 0, 0] == 40  # soft tissue
+    assert np.array_equal(inside[10, 10, 12:18], [True] * 6)
@@ -0,0 +1,82 @@
+import os
+import sys
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+import vtk
+
+import Group12
+
+
+def as_numpy(matrix):
+    return np.array([[matrix.GetElement(row, col) for col in range(4)] for row in range(4)])
+
+
+def test_matrix_matches_the_transform_chain():
+    # former implementation: actor scale + user transform, moved with Translate / RotateWXYZ in the implant axes
+    scale = 2.5
+    transform = Group12.side_transform("Right")
+    pose = Group12.ImplantPose.from_transform(transform, scale)
+    for axis, step in (("x", 5), ("z", -5), ("y", 5)):
+        vector = {"x": (1, 0, 0), "y": (0, 1, 0), "z": (0, 0, 1)}[axis]
+        transform.Translate(*np.multiply(vector, step))
+        transform.RotateWXYZ(step, *vector)
+        pose = pose.translated(np.multiply(vector, step)).rotated(vector, step)
+
+    actor = vtk.vtkActor()
+    actor.SetScale(scale, scale, scale)
+    actor.SetUserTransform(transform)
+
+    assert np.allclose(as_numpy(pose.matrix()), as_numpy(actor.GetMatrix()), atol=1e-9)
+
+
+def test_array_round_trip():
+    pose = Group12.ImplantPose((1, 2, 3), Group12.quaternion_from_axis_angle((0, 1, 0), 30), 1.5)
+    again = Group12.ImplantPose.from_array(pose.as_array())
+
+    assert np.allclose(again.as_array(), pose.as_array())
+
+
+def poses(count):
+    return [Group12.ImplantPose((i, 0, 0)) for i in range(count)]
+
+
+def test_undo_redo():
+    first, second, third = poses(3)
+    history = Group12.PoseHistory(first)
+    history.push(second)
+    history.push(third)
+
+    assert history.undo().translation[0] == 1
+    assert history.undo().translation[0] == 0
+    assert history.undo() is None
+    assert history.redo().translation[0] == 1
+    assert history.redo().translation[0] == 2
+    assert history.redo() is None
+
+
+def test_push_drops_the_redo_branch():
+    first, second, third, other = poses(4)
+    history = Group12.PoseHistory(first)
+    history.push(second)
+    history.push(third)
+    history.undo()
+    history.undo()
+    history.push(other)
+
+    assert history.redo() is None
+    assert history.undo().translation[0] == 0
+
+
+def test_max_size_forgets_the_oldest_poses():
+    all_poses = poses(40)  # more than the initial capacity too
+    history = Group12.PoseHistory(all_poses[0], max_size=10)
+    for pose in all_poses[1:]:
+        history.push(pose)
+
+    undone = []
+    while (pose := history.undo()) is not None:
+        undone.append(pose.translation[0])
+    assert undone == list(range(38, 29, -1))
@@ -0,0 +1,40 @@
+import os
+import sys
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+
+import Group12
+
+
+def test_downsampled_volume_stays_in_place():
+    mask = np.zeros((40, 16, 16), dtype=np.uint8)
+    mask[10, 4, 12] = 1  # a single bone voxel
+    spacing, origin = (0.8, 0.8, 2.5), (-10.0, 5.0, 0.0)
+    image = Group12.array_to_image(mask, spacing, origin)
+
+    factor = 8
+    output = Group12.downsample_volume(image, factor).GetOutput()
+
+    # same centre, and the bounds stay inside the original ones
+    bounds, shrunk = np.array(image.GetBounds()), np.array(output.GetBounds())
+    assert np.allclose(bounds[0::2] + bounds[1::2], shrunk[0::2] + shrunk[1::2])
+    assert np.all(shrunk[0::2] >= bounds[0::2]) and np.all(shrunk[1::2] <= bounds[1::2])
+
+    # the bone voxel is kept (max of its block), less than half a block away from where it was
+    z, y, x = np.argwhere(Group12.image_to_array(output))[0]
+    point = np.array(output.GetOrigin()) + np.array([x, y, z]) * output.GetSpacing()
+    original = np.array(origin) + np.array([12, 4, 10]) * spacing
+    assert np.all(np.abs(point - original) <= factor / 2 * np.array(spacing))
+
+
+def test_downsampling_factor_fits_the_budget():
+    memory = Group12.MemoryMonitor(budget_mb=100)
+    memory.estimate("CT image", 50)
+    memory.estimate("3D volume", 400)
+
+    assert memory.downsampling_factor("3D volume") == 2  # 50 + 400 / 8 <= 100
+    memory.estimate("3D volume", 1e9)
+    assert memory.downsampling_factor("3D volume") == Group12.MAX_DOWNSAMPLING
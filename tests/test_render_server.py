@@ -0,0 +1,104 @@
+import os
+import sys
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+import pytest
+import vtk
+from PyQt5.QtWidgets import QApplication
+
+import Group12
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    app = QApplication.instance() or QApplication([])
+    directory = tmp_path_factory.mktemp("case")
+
+    # small CT: two bone cylinders in air
+    z, y, x = np.indices((24, 32, 32))
+    ct = np.full(z.shape, -1000, dtype=np.int16)
+    ct[np.hypot(y - 10, x - 10) <= 4] = 1200
+    ct[np.hypot(y - 22, x - 22) <= 4] = 1200
+    image_path = str(directory / "ct.nii.gz")
+    writer = vtk.vtkNIFTIImageWriter()
+    writer.SetInputData(Group12.array_to_image(ct, (1, 1, 2), (0, 0, 0)))
+    writer.SetFileName(image_path)
+    writer.Write()
+
+    # implant: a cylinder
+    cylinder = vtk.vtkCylinderSource()
+    cylinder.SetRadius(0.5)
+    cylinder.SetHeight(3)
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(cylinder.GetOutputPort())
+    prosthesis_path = str(directory / "implant.stl")
+    stl = vtk.vtkSTLWriter()
+    stl.SetInputConnection(triangles.GetOutputPort())
+    stl.SetFileName(prosthesis_path)
+    stl.Write()
+
+    window = Group12.HipReplacementApp(image_path, None, prosthesis_path, "Right", offscreen=True)
+    server = Group12.RenderServer(window)
+
+    # count the renders of every view
+    server.renders = {view: 0 for view in server.render_windows}
+    for view, render_window in server.render_windows.items():
+        render_window.AddObserver("StartEvent", lambda obj, event, view=view: server.renders.__setitem__(view, server.renders[view] + 1))
+    yield server
+    window.close()
+
+
+def new_client(server):
+    return Group12.json.loads(Group12.json.dumps(server.initial_state)), {}
+
+
+def test_first_frames_are_jpeg(server):
+    state, sent_keys = new_client(server)
+    frames = server.render_changed(state, sent_keys)
+
+    assert sorted(view for view, frame in frames) == sorted(server.render_windows)
+    assert all(frame[:2] == b"\xff\xd8" for view, frame in frames)
+
+
+def test_unchanged_state_is_not_rendered_again(server):
+    state, sent_keys = new_client(server)
+    server.render_changed(state, sent_keys)
+    renders = dict(server.renders)
+
+    assert server.render_changed(state, sent_keys) == []
+    state = server.apply_command(state, {"type": "slice", "view": "axial", "index": 3})
+    assert [view for view, frame in server.render_changed(state, sent_keys)] == ["axial"]
+    state = server.apply_command(state, {"type": "slice", "view": "axial", "index": 3})  # same slice again
+    assert server.render_changed(state, sent_keys) == []
+    assert server.renders == dict(renders, axial=renders["axial"] + 1)
+
+
+def test_clients_keep_their_own_state(server):
+    first, first_keys = new_client(server)
+    second, second_keys = new_client(server)
+    server.render_changed(first, first_keys)
+    server.render_changed(second, second_keys)
+
+    moved = server.apply_command(first, {"type": "pose", "translate": [0, 0, 5]})
+    assert moved["pose"] != first["pose"]
+    assert second["pose"] == server.initial_state["pose"]
+    assert [view for view, frame in server.render_changed(moved, first_keys)] == ["3d"]
+    assert np.allclose(server.window.implant_pose.as_array(), moved["pose"])
+
+    # the other client has nothing new to receive, and its next frame uses its own pose again
+    assert server.render_changed(second, second_keys) == []
+    second = server.apply_command(second, {"type": "camera", "azimuth": 10})
+    assert [view for view, frame in server.render_changed(second, second_keys)] == ["3d"]
+    assert np.allclose(server.window.implant_pose.as_array(), server.initial_state["pose"])
+
+
+def test_bad_commands_are_rejected(server):
+    state, sent_keys = new_client(server)
+
+    with pytest.raises(ValueError):
+        server.apply_command(state, {"type": "explode"})
+    with pytest.raises(KeyError):
+        server.apply_command(state, {"type": "slice", "view": "oblique", "index": 1})